@@ -2,56 +2,100 @@ import numpy as np
 
 # Collection of activation functions
 # Reference: https://en.wikipedia.org/wiki/Activation_function
+#
+# Each function can write its result into a preallocated array with out=.
+# gradient() also accepts the output of the forward pass (output=), which the
+# functions whose derivative is expressed in their own value use instead of
+# evaluating the activation again.
+
+def _float_buffer(x, out=None):
+    """ The array to evaluate into: out, or a new float array of the shape of x """
+    if out is None:
+        out = np.empty(np.shape(x), dtype=np.result_type(np.asarray(x).dtype, np.float32))
+    return out
 
 class Sigmoid():
-    def __call__(self, x):
-        return 1 / (1 + np.exp(-x))
-
-    def gradient(self, x):
-        return self.__call__(x) * (1 - self.__call__(x))
+    def __call__(self, x, out=None):
+        out = np.negative(x, out=_float_buffer(x, out))
+        np.exp(out, out=out)
+        out += 1
+        return np.reciprocal(out, out=out)
+
+    def gradient(self, x, output=None, out=None):
+        if output is None:
+            output = self.__call__(x)
+        out = np.subtract(1, output, out=out)
+        out *= output
+        return out
 
 class Softmax():
-    def __call__(self, x):
-        e_x = np.exp(x - np.max(x, axis=-1, keepdims=True))
-        return e_x / np.sum(e_x, axis=-1, keepdims=True)
-
-    def gradient(self, x):
-        p = self.__call__(x)
-        return p * (1 - p)
+    def __call__(self, x, out=None):
+        out = np.subtract(x, np.max(x, axis=-1, keepdims=True), out=_float_buffer(x, out))
+        np.exp(out, out=out)
+        out /= np.sum(out, axis=-1, keepdims=True)
+        return out
+
+    def gradient(self, x, output=None, out=None):
+        p = self.__call__(x) if output is None else output
+        out = np.subtract(1, p, out=out)
+        out *= p
+        return out
 
 class TanH():
-    def __call__(self, x):
-        return 2 / (1 + np.exp(-2*x)) - 1
+    def __call__(self, x, out=None):
+        return np.tanh(x, out=out)
 
-    def gradient(self, x):
-        return 1 - np.power(self.__call__(x), 2)
+    def gradient(self, x, output=None, out=None):
+        if output is None:
+            output = self.__call__(x)
+        out = np.square(output, out=out)
+        np.subtract(1, out, out=out)
+        return out
 
 class ReLU():
-    def __call__(self, x):
-        return np.where(x >= 0, x, 0)
+    def __call__(self, x, out=None):
+        return np.maximum(x, 0, out=out)
 
-    def gradient(self, x):
-        return np.where(x >= 0, 1, 0)
+    def gradient(self, x, output=None, out=None):
+        if out is None:
+            return np.where(x >= 0, 1, 0)
+        return np.greater_equal(x, 0, out=out)
 
 class LeakyReLU():
     def __init__(self, alpha=0.2):
         self.alpha = alpha
 
-    def __call__(self, x):
-        return np.where(x >= 0, x, self.alpha * x)
+    def __call__(self, x, out=None):
+        out = np.multiply(x, self.alpha, out=_float_buffer(x, out))
+        if 0 <= self.alpha <= 1:
+            return np.maximum(x, out, out=out)
+        np.copyto(out, x, where=x >= 0)
+        return out
 
-    def gradient(self, x):
-        return np.where(x >= 0, 1, self.alpha)
+    def gradient(self, x, output=None, out=None):
+        out = np.greater_equal(x, 0, out=_float_buffer(x, out))
+        out *= 1 - self.alpha
+        out += self.alpha
+        return out
 
 class ELU():
     def __init__(self, alpha=0.1):
         self.alpha = alpha 
 
-    def __call__(self, x):
-        return np.where(x >= 0.0, x, self.alpha * (np.exp(x) - 1))
-
-    def gradient(self, x):
-        return np.where(x >= 0.0, 1, self.__call__(x) + self.alpha)
+    def __call__(self, x, out=None):
+        out = np.minimum(x, 0, out=_float_buffer(x, out))
+        np.expm1(out, out=out)
+        out *= self.alpha
+        np.copyto(out, x, where=x >= 0.0)
+        return out
+
+    def gradient(self, x, output=None, out=None):
+        if output is None:
+            output = self.__call__(x)
+        # alpha * exp(x) = output + alpha for x < 0
+        out = np.add(output, self.alpha, out=out)
+        np.copyto(out, 1, where=x >= 0.0)
+        return out
 
 class SELU():
     # Reference : https://arxiv.org/abs/1706.02515,
@@ -60,16 +104,30 @@ class SELU():
         self.alpha = 1.6732632423543772848170429916717
         self.scale = 1.0507009873554804934193349852946 
 
-    def __call__(self, x):
-        return self.scale * np.where(x >= 0.0, x, self.alpha*(np.exp(x)-1))
-
-    def gradient(self, x):
-        return self.scale * np.where(x >= 0.0, 1, self.alpha * np.exp(x))
+    def __call__(self, x, out=None):
+        out = np.minimum(x, 0, out=_float_buffer(x, out))
+        np.expm1(out, out=out)
+        out *= self.alpha
+        np.copyto(out, x, where=x >= 0.0)
+        out *= self.scale
+        return out
+
+    def gradient(self, x, output=None, out=None):
+        if output is None:
+            output = self.__call__(x)
+        # scale * alpha * exp(x) = output + scale * alpha for x < 0
+        out = np.add(output, self.scale * self.alpha, out=out)
+        np.copyto(out, self.scale, where=x >= 0.0)
+        return out
 
 class SoftPlus():
-    def __call__(self, x):
-        return np.log(1 + np.exp(x))
-
-    def gradient(self, x):
-        return 1 / (1 + np.exp(-x))
-
+    def __call__(self, x, out=None):
+        return np.logaddexp(0, x, out=out)
+
+    def gradient(self, x, output=None, out=None):
+        if output is None:
+            output = self.__call__(x)
+        # Sigmoid of x, which is 1 - exp(-softplus(x))
+        out = np.negative(output, out=out)
+        np.expm1(out, out=out)
+        return np.negative(out, out=out)
@@ -0,0 +1,291 @@
+from __future__ import print_function, division
+import timeit
+import tracemalloc
+import numpy as np
+from terminaltables import AsciiTable
+from mlfromscratch.deep_learning.layers import activation_functions, Dense, Conv2D, Activation, RNN
+from mlfromscratch.deep_learning.layers import BatchNormalization, Dropout, Flatten, MaxPooling2D
+from mlfromscratch.deep_learning.layers import determine_padding
+from mlfromscratch.deep_learning.layers import _image_to_column_indexed, _image_to_column_windows
+from mlfromscratch.deep_learning.layers import _column_to_image_indexed, _column_to_image_windows
+from mlfromscratch.deep_learning.optimizers import Adam, CosineAnnealing
+from mlfromscratch.deep_learning.loss_functions import SquareLoss, CrossEntropy
+from mlfromscratch.deep_learning.neural_network import NeuralNetwork
+
+
+def benchmark_activations(shape=(256, 512), repeat=5, number=50, seed=0):
+    """ Time a forward and backward pass of each activation function, once by allocating
+    new arrays and evaluating the activation again in the backward pass, and once with the
+    cached forward output and preallocated out= buffers (as the Activation layer does
+    during training).
+
+    Returns a list of (name, seconds allocating, seconds in place) per activation.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.standard_normal(shape)
+    accum_grad = rng.standard_normal(shape)
+    output, grad = np.empty(shape), np.empty(shape)
+    results = []
+    for name, Function in activation_functions.items():
+        func = Function()
+
+        def allocating():
+            func(x)
+            return accum_grad * func.gradient(x)
+
+        def in_place():
+            func(x, out=output)
+            func.gradient(x, output=output, out=grad)
+            grad.__imul__(accum_grad)
+            return grad
+
+        allocating_time = min(timeit.repeat(allocating, repeat=repeat, number=number)) / number
+        in_place_time = min(timeit.repeat(in_place, repeat=repeat, number=number)) / number
+        results.append((name, allocating_time, in_place_time))
+    return results
+
+
+def benchmark_dtypes(batch_size=256, repeat=5, number=10, seed=0):
+    """ Time a forward and backward pass (with an Adam update) of a Dense and a Conv2D
+    layer with float64 and float32 weights and inputs.
+
+    Returns a list of (layer name, seconds float64, seconds float32).
+    """
+    rng = np.random.default_rng(seed)
+    layers = [("Dense", lambda: Dense(512, input_shape=(512,)), (batch_size, 512)),
+              ("Conv2D", lambda: Conv2D(16, (3, 3), input_shape=(8, 16, 16)), (batch_size // 8, 8, 16, 16))]
+    results = []
+    for name, make_layer, input_shape in layers:
+        times = []
+        for dtype in (np.float64, np.float32):
+            np.random.seed(seed)
+            layer = make_layer()
+            layer.dtype = dtype
+            layer.initialize(optimizer=Adam())
+            X = rng.standard_normal(input_shape).astype(dtype)
+
+            def step():
+                output = layer.forward_pass(X)
+                layer.backward_pass(output)
+
+            times.append(min(timeit.repeat(step, repeat=repeat, number=number)) / number)
+        results.append((name,) + tuple(times))
+    return results
+
+
+def benchmark_fused_optimizer(n_layers=16, n_units=16, batch_size=16, repeat=5, number=20, seed=0):
+    """ Time train_on_batch of a deep, narrow Dense network (where the many small
+    optimizer updates dominate) with one Adam update per parameter and with the fused
+    optimizer that steps one flat buffer in place.
+
+    Returns (seconds per parameter, seconds fused).
+    """
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((batch_size, n_units))
+    y = rng.standard_normal((batch_size, n_units))
+    times = []
+    for fused_optimizer in (False, True):
+        np.random.seed(seed)
+        model = NeuralNetwork(optimizer=Adam(), loss=SquareLoss, fused_optimizer=fused_optimizer)
+        model.add(Dense(n_units, input_shape=(n_units,)))
+        for _ in range(n_layers - 1):
+            model.add(Activation('relu'))
+            model.add(Dense(n_units))
+        times.append(min(timeit.repeat(lambda: model.train_on_batch(X, y),
+                                       repeat=repeat, number=number)) / number)
+    return tuple(times)
+
+
+class _UncorrectedAdam(Adam):
+    """ Adam with the former bias correction m / (1 - b1) and v / (1 - b2), i.e. the
+    correction of the first step applied to every step """
+    def step(self, w, grad_wrt_w):
+        self.t = 0
+        super(_UncorrectedAdam, self).step(w, grad_wrt_w)
+
+
+def benchmark_adam_bias_correction(target_loss=0.01, max_epochs=200, batch_size=32, seed=0):
+    """ Epochs a small regression network needs to reach target_loss with the former,
+    uncorrected Adam and with bias corrected Adam, and with bias corrected Adam at a three
+    times higher learning rate with and without a cosine schedule (None if it is not
+    reached within max_epochs). """
+    rng = np.random.default_rng(seed)
+    X = rng.standard_normal((512, 8))
+    y = np.sin(X[:, :2]).sum(axis=1, keepdims=True)
+    results = []
+    for name, optimizer, scheduler in [("Adam, uncorrected", _UncorrectedAdam(), None),
+                                       ("Adam", Adam(), None),
+                                       ("Adam, lr=0.003", Adam(learning_rate=0.003), None),
+                                       ("Adam, lr=0.003, cosine", Adam(learning_rate=0.003),
+                                        CosineAnnealing(max_epochs))]:
+        np.random.seed(seed)
+        model = NeuralNetwork(optimizer=optimizer, loss=SquareLoss)
+        model.progressbar = lambda iterable: iterable
+        model.add(Dense(32, input_shape=(8,)))
+        model.add(Activation('tanh'))
+        model.add(Dense(1))
+        model.fit(X, y, n_epochs=max_epochs, batch_size=batch_size, scheduler=scheduler)
+        reached = np.flatnonzero(np.array(model.errors["training"]) <= target_loss)
+        results.append((name, int(reached[0]) + 1 if len(reached) else None))
+    return results
+
+
+def benchmark_im2col(images_shape=(32, 16, 28, 28), filter_shape=(3, 3), strides=(1, 2),
+                     repeat=5, number=5, seed=0):
+    """ Time image_to_column followed by column_to_image ('same' padding) through the
+    im2col index arrays (gather and np.add.at) and through strided windows.
+
+    Returns a list of (stride, seconds indexed, seconds windows).
+    """
+    rng = np.random.default_rng(seed)
+    images = rng.standard_normal(images_shape)
+    padding = determine_padding(filter_shape, "same")
+    images_padded = np.pad(images, ((0, 0), (0, 0)) + padding, mode='constant')
+    results = []
+    for stride in strides:
+        def indexed():
+            cols = _image_to_column_indexed(images_padded, images_shape, filter_shape, padding, stride)
+            _column_to_image_indexed(cols, images_padded.shape, images_shape, filter_shape, padding, stride)
+
+        def windows():
+            cols = _image_to_column_windows(images_padded, filter_shape, stride)
+            _column_to_image_windows(cols, images_padded.shape, filter_shape, stride)
+
+        indexed_time = min(timeit.repeat(indexed, repeat=repeat, number=number)) / number
+        windows_time = min(timeit.repeat(windows, repeat=repeat, number=number)) / number
+        results.append((stride, indexed_time, windows_time))
+    return results
+
+
+class _LoopRNN(RNN):
+    """ RNN with the former backward pass: a loop over the time steps with an inner loop
+    over the truncated history, evaluating the activation gradient in the inner loop """
+    def backward_pass(self, accum_grad):
+        _, timesteps, _ = accum_grad.shape
+        grad_U = np.zeros_like(self.U)
+        grad_V = np.zeros_like(self.V)
+        grad_W = np.zeros_like(self.W)
+        accum_grad_next = np.zeros_like(accum_grad)
+        for t in reversed(range(timesteps)):
+            grad_V += accum_grad[:, t].T.dot(self.states[:, t])
+            grad_wrt_state = accum_grad[:, t].dot(self.V) * self.activation.gradient(self.state_input[:, t])
+            accum_grad_next[:, t] = grad_wrt_state.dot(self.U)
+            for t_ in reversed(np.arange(max(0, t - self.bptt_trunc), t+1)):
+                grad_U += grad_wrt_state.T.dot(self.layer_input[:, t_])
+                grad_W += grad_wrt_state.T.dot(self.states[:, t_-1])
+                grad_wrt_state = grad_wrt_state.dot(self.W) * self.activation.gradient(self.state_input[:, t_-1])
+        self._update_parameter("U", grad_U)
+        self._update_parameter("V", grad_V)
+        self._update_parameter("W", grad_W)
+        return accum_grad_next
+
+
+def benchmark_rnn(sequence_lengths=(10, 50, 100, 200), batch_size=32, n_units=32, input_dim=16,
+                  bptt_trunc=5, repeat=3, number=3, seed=0):
+    """ Time a forward and backward pass of an RNN layer with the former looped
+    backpropagation through time and with the vectorized one, for every sequence length.
+
+    Returns a list of (sequence length, seconds looped, seconds vectorized).
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for timesteps in sequence_lengths:
+        X = rng.standard_normal((batch_size, timesteps, input_dim))
+        times = []
+        for Layer in (_LoopRNN, RNN):
+            np.random.seed(seed)
+            layer = Layer(n_units, bptt_trunc=bptt_trunc, input_shape=(timesteps, input_dim))
+            layer.initialize(optimizer=Adam())
+
+            def step():
+                output = layer.forward_pass(X)
+                layer.backward_pass(output)
+
+            times.append(min(timeit.repeat(step, repeat=repeat, number=number)) / number)
+        results.append((timesteps,) + tuple(times))
+    return results
+
+
+def _peak_memory(func):
+    """ The peak of the memory allocated while func runs, in bytes """
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_inference(n_samples=1024, max_batch_size=256, repeat=5, number=5, seed=0):
+    """ Latency and peak memory of predict of a convolutional network with batch
+    normalization and dropout, uncompiled and compiled with compile_for_inference. The
+    uncompiled model predicts all samples at once and in batches of max_batch_size. The
+    peak memory of the compiled model does not include its preallocated buffers.
+
+    Returns a list of (name, seconds, peak bytes).
+    """
+    np.random.seed(seed)
+    model = NeuralNetwork(optimizer=Adam(), loss=CrossEntropy)
+    for layer in [Conv2D(16, (3, 3), input_shape=(1, 28, 28)), BatchNormalization(), Activation("relu"),
+                  MaxPooling2D((2, 2), stride=2), Flatten(), Dense(128), BatchNormalization(),
+                  Activation("relu"), Dropout(0.25), Dense(10), Activation("softmax")]:
+        model.add(layer)
+    X = np.random.default_rng(seed).standard_normal((n_samples, 1, 28, 28))
+    # Initializes the running statistics of batch normalization
+    model.predict(X[:max_batch_size])
+    compiled = model.compile_for_inference(max_batch_size=max_batch_size)
+
+    predictors = [("predict", lambda: model.predict(X)),
+                  ("predict (batch_size=%d)" % max_batch_size, lambda: model.predict(X, batch_size=max_batch_size)),
+                  ("compile_for_inference", lambda: compiled.predict(X))]
+    results = []
+    for name, predict in predictors:
+        seconds = min(timeit.repeat(predict, repeat=repeat, number=number)) / number
+        results.append((name, seconds, _peak_memory(predict)))
+    return results
+
+
+def main():
+    table_data = [["Activation", "Allocating (ms)", "In place (ms)", "Speedup"]]
+    for name, allocating_time, in_place_time in benchmark_activations():
+        table_data.append([name, "%.3f" % (1e3 * allocating_time), "%.3f" % (1e3 * in_place_time),
+                           "%.2fx" % (allocating_time / in_place_time)])
+    print (AsciiTable(table_data).table)
+
+    table_data = [["Layer", "float64 (ms)", "float32 (ms)", "Speedup"]]
+    for name, float64_time, float32_time in benchmark_dtypes():
+        table_data.append([name, "%.3f" % (1e3 * float64_time), "%.3f" % (1e3 * float32_time),
+                           "%.2fx" % (float64_time / float32_time)])
+    print (AsciiTable(table_data).table)
+
+    per_parameter_time, fused_time = benchmark_fused_optimizer()
+    table_data = [["Optimizer", "train_on_batch (ms)"],
+                  ["Per parameter", "%.3f" % (1e3 * per_parameter_time)],
+                  ["Fused", "%.3f" % (1e3 * fused_time)]]
+    print (AsciiTable(table_data).table)
+
+    table_data = [["im2col + col2im", "Indexed (ms)", "Windows (ms)", "Speedup"]]
+    for stride, indexed_time, windows_time in benchmark_im2col():
+        table_data.append(["stride %d" % stride, "%.3f" % (1e3 * indexed_time), "%.3f" % (1e3 * windows_time),
+                           "%.2fx" % (indexed_time / windows_time)])
+    print (AsciiTable(table_data).table)
+
+    table_data = [["RNN time steps", "Looped BPTT (ms)", "Vectorized BPTT (ms)", "Speedup"]]
+    for timesteps, looped_time, vectorized_time in benchmark_rnn():
+        table_data.append([str(timesteps), "%.3f" % (1e3 * looped_time), "%.3f" % (1e3 * vectorized_time),
+                           "%.2fx" % (looped_time / vectorized_time)])
+    print (AsciiTable(table_data).table)
+
+    table_data = [["Optimizer", "Epochs to loss 0.01"]]
+    for name, epochs in benchmark_adam_bias_correction(target_loss=0.01):
+        table_data.append([name, str(epochs) if epochs else "not reached"])
+    print (AsciiTable(table_data).table)
+
+    table_data = [["Inference", "Latency (ms)", "Peak memory (MB)"]]
+    for name, seconds, peak in benchmark_inference():
+        table_data.append([name, "%.3f" % (1e3 * seconds), "%.1f" % (peak / 2**20)])
+    print (AsciiTable(table_data).table)
+
+
+if __name__ == "__main__":
+    main()
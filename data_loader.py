@@ -0,0 +1,213 @@
+from __future__ import print_function, division
+import os
+import threading
+import queue
+import numpy as np
+
+
+def open_array(source):
+    """ The array of a source. Paths of .npy files are memory-mapped read-only, so that
+    only the samples that are read are loaded. Anything else is returned as it is. """
+    if isinstance(source, (str, os.PathLike)):
+        return np.load(source, mmap_mode="r")
+    return source
+
+
+def in_memory(source):
+    """ True if the source is an array that is already in memory """
+    return not isinstance(source, (str, os.PathLike, np.memmap, ChunkedSource))
+
+
+class ChunkedSource():
+    """A data source that is read one chunk at a time, e.g. one file per day of data.
+
+    Parameters:
+    -----------
+    chunks: iterable or function
+        The chunks, as (X_chunk, y_chunk) pairs or X_chunk arrays. Arrays may be given as
+        paths of .npy files. Every epoch iterates over the chunks again, so a generator
+        should be passed as a function that returns a new generator.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        chunks = self.chunks() if callable(self.chunks) else self.chunks
+        for chunk in chunks:
+            X_chunk, y_chunk = chunk if isinstance(chunk, tuple) else (chunk, None)
+            yield open_array(X_chunk), open_array(y_chunk)
+
+
+class DataLoader():
+    """Iterates over mini-batches of (X, y), one epoch per iteration. With prefetch a
+    background thread gathers the next batch while the current one is used, into one of
+    two preallocated contiguous buffers that are reused for the whole training. A batch
+    is therefore only valid until the next one is requested. Only the samples of the
+    batches in flight are read, so memory-mapped and chunked sources never need to fit
+    in memory.
+
+    Parameters:
+    -----------
+    X: array_like, string or ChunkedSource
+        The samples, indexed along the first axis. A path of a .npy file is memory-mapped.
+        With a ChunkedSource y is not used.
+    y: array_like or string
+        The targets (optional).
+    batch_size: int
+        The number of samples per batch. The last batch of an epoch may be smaller.
+    shuffle: boolean
+        If True every epoch visits the samples in a new random order. Only an index
+        permutation is drawn, the data itself is not copied. The chunks of a ChunkedSource
+        keep their order and are shuffled internally.
+    seed: int
+        Seed of the shuffling.
+    prefetch: boolean
+        If True batches are prepared by a background thread.
+    dtype: numpy dtype
+        The dtype of the X batches. Defaults to the dtype of X.
+    transform: function
+        Optional function (X_batch, y_batch) -> (X_batch, y_batch), e.g. augmentation,
+        applied on the background thread.
+    block_size: int
+        If set, shuffling permutes blocks of block_size consecutive samples and the samples
+        within each block, so that batches read from a few nearby places on disk.
+    """
+    def __init__(self, X, y=None, batch_size=64, shuffle=False, seed=None, prefetch=True,
+                 dtype=None, transform=None, block_size=None):
+        self.X = open_array(X)
+        self.y = open_array(y)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.prefetch = prefetch
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.transform = transform
+        self.block_size = block_size
+        self.buffers = None
+
+    def __len__(self):
+        if isinstance(self.X, ChunkedSource):
+            raise TypeError("The number of batches of a ChunkedSource is not known")
+        return -(-len(self.X) // self.batch_size)
+
+    def __iter__(self):
+        batches = self._epoch_batches()
+        if not self.prefetch:
+            for segments in batches:
+                yield self._load(segments, 0)
+            return
+
+        # Handshake between the threads: the loader takes a free buffer, fills it and
+        # hands it over as ready; the consumer frees it when it asks for the next batch
+        free, ready = queue.Queue(), queue.Queue()
+        for buffer_i in range(2):
+            free.put(buffer_i)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(batches, free, ready, stop))
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                buffer_i, batch = item
+                yield batch
+                free.put(buffer_i)
+        finally:
+            stop.set()
+            free.put(None)
+            thread.join()
+
+    def _worker(self, batches, free, ready, stop):
+        try:
+            for segments in batches:
+                buffer_i = free.get()
+                if buffer_i is None or stop.is_set():
+                    return
+                ready.put((buffer_i, self._load(segments, buffer_i)))
+            ready.put(None)
+        except BaseException as e:
+            ready.put(e)
+
+    def _epoch_batches(self):
+        """ The batches of one epoch. Each batch is a list of segments (X, y, indices) whose
+        samples are copied one after the other into the batch buffer. """
+        if isinstance(self.X, ChunkedSource):
+            return self._chunk_batches()
+        n_samples = len(self.X)
+        starts = range(0, n_samples, self.batch_size)
+        if not self.shuffle:
+            return ([(self.X, self.y, slice(start, min(start + self.batch_size, n_samples)))]
+                    for start in starts)
+        permutation = self._permutation(n_samples)
+        # The order within a batch does not matter, and sorted reads are faster
+        return ([(self.X, self.y, np.sort(permutation[start:start + self.batch_size]))]
+                for start in starts)
+
+    def _permutation(self, n_samples):
+        if not self.block_size:
+            return self.rng.permutation(n_samples)
+        block_starts = self.rng.permutation(np.arange(0, n_samples, self.block_size))
+        return np.concatenate([start + self.rng.permutation(min(self.block_size, n_samples - start))
+                               for start in block_starts])
+
+    def _chunk_batches(self):
+        # Samples left over at the end of a chunk are completed from the next chunk
+        pending, n_pending = [], 0
+        for X_chunk, y_chunk in self.X:
+            n_chunk = len(X_chunk)
+            order = self.rng.permutation(n_chunk) if self.shuffle else None
+            position = 0
+            while position < n_chunk:
+                n_taken = min(self.batch_size - n_pending, n_chunk - position)
+                if order is None:
+                    indices = slice(position, position + n_taken)
+                else:
+                    indices = np.sort(order[position:position + n_taken])
+                pending.append((X_chunk, y_chunk, indices))
+                n_pending += n_taken
+                position += n_taken
+                if n_pending == self.batch_size:
+                    yield pending
+                    pending, n_pending = [], 0
+        if pending:
+            yield pending
+
+    def _allocate(self, X, y):
+        X_buffer = np.empty((self.batch_size,) + np.shape(X)[1:], dtype=self.dtype or X.dtype)
+        y_buffer = None
+        if y is not None:
+            y_buffer = np.empty((self.batch_size,) + np.shape(y)[1:], dtype=y.dtype)
+        return X_buffer, y_buffer
+
+    def _load(self, segments, buffer_i):
+        """ Copy the samples of the segments into buffer buffer_i and return views of the
+        filled part """
+        if self.buffers is None:
+            X, y, _ = segments[0]
+            self.buffers = [self._allocate(X, y) for _ in range(2)]
+        X_buffer, y_buffer = self.buffers[buffer_i]
+        n_batch = 0
+        for X, y, indices in segments:
+            n = self._gather(X, indices, X_buffer[n_batch:])
+            if y is not None:
+                self._gather(y, indices, y_buffer[n_batch:])
+            n_batch += n
+        X_batch = X_buffer[:n_batch]
+        y_batch = None if y_buffer is None else y_buffer[:n_batch]
+        if self.transform is not None:
+            X_batch, y_batch = self.transform(X_batch, y_batch)
+        return X_batch, y_batch
+
+    @staticmethod
+    def _gather(data, indices, out):
+        if isinstance(indices, slice):
+            n = indices.stop - indices.start
+            out[:n] = data[indices]
+        else:
+            n = len(indices)
+            np.take(data, indices, axis=0, out=out[:n])
+        return n
@@ -1,8 +1,103 @@
 from __future__ import division, print_function
+import heapq
 import numpy as np
 
-from mlfromscratch.utils import divide_on_feature, train_test_split, standardize, mean_squared_error
-from mlfromscratch.utils import calculate_entropy, accuracy_score, calculate_variance
+from mlfromscratch.utils import train_test_split, standardize, mean_squared_error, accuracy_score
+
+def bin_features(X, max_bins=255, feature_index=None):
+    """ Quantile-bin every feature of X (or the columns feature_index) into uint8 codes.
+    A feature with at most max_bins unique values gets one bin per value, so no split
+    points are lost.
+
+    Returns the codes and, per feature, the edges such that code k means
+    edges[k-1] <= x < edges[k].
+    """
+    n_samples, n_features = np.shape(X)
+    if feature_index is None:
+        feature_index = range(n_features)
+    codes = np.empty((n_samples, len(feature_index)), dtype=np.uint8)
+    bin_edges = []
+    for column_i, feature_i in enumerate(feature_index):
+        feature_values = np.asarray(X[:, feature_i], dtype=float)
+        unique_values = np.unique(feature_values)
+        if len(unique_values) <= max_bins:
+            edges = unique_values[1:]
+        else:
+            quantiles = np.linspace(0, 1, max_bins + 1)[1:-1]
+            edges = np.unique(np.quantile(feature_values, quantiles))
+            edges = edges[edges > unique_values[0]]
+        codes[:, column_i] = np.searchsorted(edges, feature_values, side="right")
+        bin_edges.append(edges)
+    return codes, bin_edges
+
+
+def is_numeric(threshold):
+    """ Numeric thresholds split on 'value >= threshold', others on 'value == threshold' """
+    return isinstance(threshold, int) or isinstance(threshold, float)
+
+
+def meets_threshold(feature_values, threshold):
+    """ Boolean mask of the feature values that go to the true branch of a node """
+    if is_numeric(threshold):
+        return feature_values >= threshold
+    return feature_values == threshold
+
+
+# Impurity of nodes given their summed statistics s, where s[..., 0] is the number of
+# samples. Every function scores any number of candidate nodes in one call.
+def entropy(s):
+    """ Entropy of class counts s[..., 1:] """
+    p = s[..., 1:] / s[..., :1]
+    return -np.sum(p * np.log2(np.where(p > 0, p, 1)), axis=-1)
+
+
+def gini(s):
+    """ Gini impurity of class counts s[..., 1:] """
+    p = s[..., 1:] / s[..., :1]
+    return 1 - np.sum(np.power(p, 2), axis=-1)
+
+
+def variance(s):
+    """ Summed variance of the outputs given sums s[..., 1:d+1] and sums of squares s[..., d+1:] """
+    n_outputs = (s.shape[-1] - 1) // 2
+    mean = s[..., 1:n_outputs + 1] / s[..., :1]
+    return np.sum(s[..., n_outputs + 1:] / s[..., :1] - np.power(mean, 2), axis=-1)
+
+
+def impurity_decrease(total, true_stats, false_stats, impurity):
+    """ Decrease of impurity when splitting a node with statistics total into branches """
+    p = true_stats[..., 0] / total[..., 0]
+    return impurity(total) - p * impurity(true_stats) - (1 - p) * impurity(false_stats)
+
+
+def best_threshold(values, statistics, split_gain, numeric=True):
+    """ Score every candidate threshold of a feature in one call.
+
+    values: The sorted unique values of the feature.
+    statistics: The summed statistics of the samples with each value.
+    split_gain: Function of (total, true_stats, false_stats) that scores splits.
+    numeric: If samples >= threshold go to the true branch. Otherwise samples == threshold.
+
+    Returns the largest gain and its threshold, or (-inf, None) if no split exists.
+    """
+    total = np.sum(statistics, axis=0)
+    if numeric:
+        false_stats = np.cumsum(statistics, axis=0)[:-1]
+        true_stats = total - false_stats
+        candidates = values[1:]
+    else:
+        true_stats = statistics
+        false_stats = total - statistics
+        candidates = values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gain = split_gain(total, true_stats, false_stats)
+    valid = (true_stats[..., 0] > 0) & (false_stats[..., 0] > 0) & ~np.isnan(gain)
+    if not np.any(valid):
+        return -np.inf, None
+    gain = np.where(valid, gain, -np.inf)
+    i = np.argmax(gain)
+    return gain[i], candidates[i]
+
 
 class DecisionNode():
     """Class that represents a decision node or leaf in the decision tree
@@ -30,6 +125,74 @@ class DecisionNode():
         self.false_branch = false_branch    # 'Right' subtree
 
 
+class FlatTree():
+    """A fitted decision tree compiled into parallel arrays, one entry per node, which
+    lets a whole batch of samples be moved down the tree level by level.
+
+    Parameters:
+    -----------
+    root: DecisionNode
+        The root node of the fitted tree.
+    """
+    def __init__(self, root):
+        feature, threshold, equality, true_child, false_child, leaf_i = [], [], [], [], [], []
+        leaf_values = []
+        # Iterative pre-order walk. Children get their ids when they are popped.
+        stack = [(root, None, None)]
+        while stack:
+            node, parent_i, is_true_branch = stack.pop()
+            node_i = len(feature)
+            if parent_i is not None:
+                (true_child if is_true_branch else false_child)[parent_i] = node_i
+            true_child.append(-1)
+            false_child.append(-1)
+            if node.value is not None:
+                feature.append(-1)
+                threshold.append(0)
+                equality.append(False)
+                leaf_i.append(len(leaf_values))
+                leaf_values.append(node.value)
+            else:
+                feature.append(node.feature_i)
+                threshold.append(node.threshold)
+                equality.append(not is_numeric(node.threshold))
+                leaf_i.append(-1)
+                stack.append((node.false_branch, node_i, False))
+                stack.append((node.true_branch, node_i, True))
+
+        self.feature = np.array(feature, dtype=np.intp)          # Feature tested, -1 at leaves
+        self.threshold = np.array(threshold)                      # Threshold of the test
+        self.equality = np.array(equality, dtype=bool)            # Test is '==' instead of '>='
+        self.true_child = np.array(true_child, dtype=np.intp)    # Node id of 'left' subtree
+        self.false_child = np.array(false_child, dtype=np.intp)  # Node id of 'right' subtree
+        self.leaf_i = np.array(leaf_i, dtype=np.intp)            # Row in leaf_values, -1 if split
+        self.leaf_values = np.array(leaf_values)
+
+    def supports(self, X):
+        """ Whether X can be handled by the vectorized predict """
+        return (np.issubdtype(X.dtype, np.number) or X.dtype == bool) and \
+            np.issubdtype(self.threshold.dtype, np.number)
+
+    def apply(self, X):
+        """ Return the id of the leaf node that every sample in X ends up in """
+        node = np.zeros(len(X), dtype=np.intp)
+        active = np.arange(len(X))
+        while len(active) > 0:
+            feature = self.feature[node[active]]
+            is_split = feature >= 0
+            active, feature = active[is_split], feature[is_split]
+            current = node[active]
+            feature_values = X[active, feature]
+            threshold = self.threshold[current]
+            goes_true = np.where(self.equality[current], feature_values == threshold,
+                                 feature_values >= threshold)
+            node[active] = np.where(goes_true, self.true_child[current], self.false_child[current])
+        return node
+
+    def predict(self, X):
+        return self.leaf_values[self.leaf_i[self.apply(X)]]
+
+
 # Super class of RegressionTree and ClassificationTree
 class DecisionTree(object):
     """Super class of RegressionTree and ClassificationTree.
@@ -44,9 +207,21 @@ class DecisionTree(object):
         The maximum depth of a tree.
     loss: function
         Loss function that is used for Gradient Boosting models to calculate impurity.
+    splitter: string
+        Either 'best', 'presort' or 'hist'. 'best' tries every unique feature value as a
+        threshold. 'presort' finds the same exact splits (with the same '>=' or '==' rule
+        per feature) by sweeping each feature in an order sorted once at fit time. 'hist'
+        quantile-bins each feature once before training and scores the thresholds of a node
+        from cumulative per-bin statistics.
+    max_bins: int
+        The maximum number of bins per feature when splitter is 'hist' (at most 256).
+    max_leaves: int
+        If set (splitter 'hist' only) the tree is grown leaf-wise, always splitting the leaf
+        with the largest impurity decrease, until it has max_leaves leaves.
     """
     def __init__(self, min_samples_split=2, min_impurity=1e-7,
-                 max_depth=float("inf"), loss=None):
+                 max_depth=float("inf"), loss=None, splitter="best", max_bins=255,
+                 max_leaves=None):
         self.root = None  # Root node in dec. tree
         # Minimum n of samples to justify split
         self.min_samples_split = min_samples_split
@@ -54,113 +229,350 @@ class DecisionTree(object):
         self.min_impurity = min_impurity
         # The maximum depth to grow the tree to
         self.max_depth = max_depth
-        # Function to calculate impurity (classif.=>info gain, regr=>variance reduct.)
-        self._impurity_calculation = None
         # Function to determine prediction of y at leaf
         self._leaf_value_calculation = None
         # If y is one-hot encoded (multi-dim) or not (one-dim)
         self.one_dim = None
         # If Gradient Boost
         self.loss = loss
-
-    def fit(self, X, y, loss=None):
-        """ Build decision tree """
+        # Strategy used to search for the best split
+        if splitter not in ("best", "presort", "hist"):
+            raise ValueError("Unknown splitter '%s'" % splitter)
+        self.splitter = splitter
+        if not 2 <= max_bins <= 256:
+            raise ValueError("max_bins must be between 2 and 256")
+        self.max_bins = max_bins
+        if max_leaves is not None and splitter != "hist":
+            raise ValueError("max_leaves requires splitter 'hist'")
+        self.max_leaves = max_leaves
+        # (start, stop, value) of every leaf in the sample_index buffer passed to fit.
+        # Lets ensembles update training predictions without predicting X again.
+        self.leaf_slices = []
+        # Function that maps y to per sample statistics which can be summed
+        self._split_statistics = None
+        # Function to calculate impurity decrease from summed statistics
+        # (classif.=>info gain, regr=>variance reduct.)
+        self._statistics_impurity = None
+
+    def fit(self, X, y, loss=None, sample_index=None, feature_index=None, binned=None):
+        """ Build decision tree
+
+        sample_index: Row indices of X (and y) to train on, by default all rows. The
+            array is used as the partition buffer of the tree and is reordered in place,
+            so ensembles can hand the same buffer to every tree they fit.
+        feature_index: Columns of X that may be used for splits, by default all columns.
+        binned: The output of bin_features(X) for the hist splitter. Ensembles bin X once
+            and pass it to every tree.
+        """
         self.one_dim = len(np.shape(y)) == 1
-        self.root = self._build_tree(X, y)
+        # Check if expansion of y is needed
+        if self.one_dim:
+            y = np.expand_dims(y, axis=1)
+        if sample_index is None:
+            sample_index = np.arange(np.shape(X)[0])
+        # Nodes own the slice [start, stop) of this buffer
+        self._sample_index = sample_index
+        if feature_index is None:
+            feature_index = np.arange(np.shape(X)[1])
+        self._feature_index = feature_index
+        self._statistics = self._summable_statistics(y)
+        self.leaf_slices = []
+        try:
+            if self.splitter == "hist":
+                self.root = self._build_hist_tree(X, y, binned)
+            elif self.splitter == "presort":
+                self.root = self._build_presorted_tree(X, y)
+            else:
+                self.root = self._build_tree(X, y, 0, len(sample_index))
+        finally:
+            del self._sample_index, self._feature_index, self._statistics
+        self.flat_tree = FlatTree(self.root)
         self.loss=None
 
-    def _build_tree(self, X, y, current_depth=0):
-        """ Recursive method which builds out the decision tree and splits X and respective y
-        on the feature of X which (based on impurity) best separates the data"""
+    def _partition(self, goes_true, start, stop):
+        """ Move the samples of the node [start, stop) that go to the true branch to the front
+        of the node's slice of the index buffer. Returns the number of such samples. """
+        node_index = self._sample_index[start:stop]
+        n_true = np.count_nonzero(goes_true)
+        node_index[:] = np.concatenate((node_index[goes_true], node_index[~goes_true]))
+        return n_true
+
+    def _build_tree(self, X, y, start, stop, current_depth=0):
+        """ Recursive method which builds out the decision tree and splits the samples
+        [start, stop) of the index buffer on the feature of X which (based on impurity)
+        best separates the data. X and y are never copied. """
 
         largest_impurity = 0
         best_criteria = None    # Feature index and threshold
-        best_sets = None        # Subsets of the data
-
-        # Check if expansion of y is needed
-        if len(np.shape(y)) == 1:
-            y = np.expand_dims(y, axis=1)
 
-        # Add y as last column of X
-        Xy = np.concatenate((X, y), axis=1)
-
-        n_samples, n_features = np.shape(X)
+        node_index = self._sample_index[start:stop]
+        n_samples = len(node_index)
 
         if n_samples >= self.min_samples_split and current_depth <= self.max_depth:
+            statistics = self._statistics[node_index]
             # Calculate the impurity for each feature
-            for feature_i in range(n_features):
-                # All values of feature_i
-                feature_values = np.expand_dims(X[:, feature_i], axis=1)
-                unique_values = np.unique(feature_values)
-
-                # Iterate through all unique values of feature column i and
-                # calculate the impurity
-                for threshold in unique_values:
-                    # Divide X and y depending on if the feature value of X at index feature_i
-                    # meets the threshold
-                    Xy1, Xy2 = divide_on_feature(Xy, feature_i, threshold)
-
-                    if len(Xy1) > 0 and len(Xy2) > 0:
-                        # Select the y-values of the two sets
-                        y1 = Xy1[:, n_features:]
-                        y2 = Xy2[:, n_features:]
-
-                        # Calculate impurity
-                        impurity = self._impurity_calculation(y, y1, y2)
-
-                        # If this threshold resulted in a higher information gain than previously
-                        # recorded save the threshold value and the feature
-                        # index
-                        if impurity > largest_impurity:
-                            largest_impurity = impurity
-                            best_criteria = {"feature_i": feature_i, "threshold": threshold}
-                            best_sets = {
-                                "leftX": Xy1[:, :n_features],   # X of left subtree
-                                "lefty": Xy1[:, n_features:],   # y of left subtree
-                                "rightX": Xy2[:, :n_features],  # X of right subtree
-                                "righty": Xy2[:, n_features:]   # y of right subtree
-                                }
+            for feature_i in self._feature_index:
+                # All values of feature_i, sorted
+                feature_values = X[node_index, feature_i]
+                order = np.argsort(feature_values, kind="stable")
+                feature_values = feature_values[order]
+
+                # Score all unique values of feature column i as thresholds at once
+                impurity, threshold = self._best_threshold_of_sorted(
+                    feature_values, statistics[order], numeric=is_numeric(feature_values[0]))
+
+                # If this threshold resulted in a higher information gain than previously
+                # recorded save the threshold value and the feature
+                # index
+                if impurity > largest_impurity:
+                    largest_impurity = impurity
+                    best_criteria = {"feature_i": feature_i, "threshold": threshold}
 
         if largest_impurity > self.min_impurity:
+            feature_i, threshold = best_criteria["feature_i"], best_criteria["threshold"]
+            goes_true = meets_threshold(X[node_index, feature_i], threshold)
+            split = start + self._partition(goes_true, start, stop)
             # Build subtrees for the right and left branches
-            true_branch = self._build_tree(best_sets["leftX"], best_sets["lefty"], current_depth + 1)
-            false_branch = self._build_tree(best_sets["rightX"], best_sets["righty"], current_depth + 1)
-            return DecisionNode(feature_i=best_criteria["feature_i"], threshold=best_criteria[
-                                "threshold"], true_branch=true_branch, false_branch=false_branch)
+            true_branch = self._build_tree(X, y, start, split, current_depth + 1)
+            false_branch = self._build_tree(X, y, split, stop, current_depth + 1)
+            return DecisionNode(feature_i=int(feature_i), threshold=threshold,
+                                true_branch=true_branch, false_branch=false_branch)
 
         # We're at leaf => determine value
-        leaf_value = self._leaf_value_calculation(y)
+        return self._leaf(y, start, stop)
 
+    def _leaf(self, y, start, stop):
+        """ Leaf node for the samples [start, stop) of the index buffer """
+        leaf_value = self._leaf_value_calculation(y[self._sample_index[start:stop]])
+        self.leaf_slices.append((start, stop, leaf_value))
         return DecisionNode(value=leaf_value)
 
+    def _best_threshold_of_sorted(self, feature_values, statistics, numeric=True):
+        """ Collapse samples sorted by feature value into one row of statistics per unique
+        value and score every threshold of the feature in one call """
+        starts = np.flatnonzero(np.concatenate(([True], feature_values[1:] != feature_values[:-1])))
+        return best_threshold(feature_values[starts], np.add.reduceat(statistics, starts, axis=0),
+                              self._statistics_impurity, numeric)
+
+    def _build_hist_tree(self, X, y, binned=None):
+        """ Bin the features of X once (unless already binned) and build the tree from
+        per-bin statistics """
+        if binned is None:
+            self._codes, self._bin_edges = bin_features(X, self.max_bins, self._feature_index)
+            # Column of the codes that holds each candidate feature
+            self._code_columns = np.arange(len(self._feature_index))
+        else:
+            self._codes, self._bin_edges = binned
+            self._code_columns = np.asarray(self._feature_index)
+        n_bins = max(len(self._bin_edges[c]) for c in self._code_columns) + 1
+        # Offsets which give every (feature, bin) pair its own slot in one flat histogram
+        self._bin_offsets = np.arange(len(self._feature_index)) * n_bins
+        self._n_bins = n_bins
+        try:
+            root_histogram = self._histogram(self._sample_index)
+            if self.max_leaves is not None:
+                return self._grow_hist_tree_leaf_wise(y, root_histogram)
+            return self._grow_hist_tree(y, 0, len(self._sample_index), root_histogram)
+        finally:
+            del self._codes, self._code_columns
+
+    def _summable_statistics(self, y):
+        """ Per sample statistics of y. Count of samples is the first statistic. Used to
+        reject empty branches. """
+        statistics = self._split_statistics(y)
+        return np.concatenate((np.ones((len(y), 1)), statistics), axis=1)
+
+    def _build_presorted_tree(self, X, y):
+        """ Sort the samples by every candidate feature once. Nodes then own the slice
+        [start, stop) of every sorted row of the buffer, which is partitioned stably. """
+        rows = self._sample_index
+        self._sorted_index = np.empty((len(self._feature_index), len(rows)), dtype=np.intp)
+        for column_i, feature_i in enumerate(self._feature_index):
+            self._sorted_index[column_i] = rows[np.argsort(X[rows, feature_i], kind="stable")]
+        try:
+            return self._grow_presorted_tree(X, y, 0, len(rows))
+        finally:
+            del self._sorted_index
+
+    def _best_presorted_split(self, X, start, stop):
+        """ Sweep every sorted feature once with running statistics of the samples below
+        each candidate threshold """
+        largest_impurity, best_criteria = 0, None
+        for column_i, feature_i in enumerate(self._feature_index):
+            rows = self._sorted_index[column_i, start:stop]
+            feature_values = X[rows, feature_i]
+            impurity, threshold = self._best_threshold_of_sorted(
+                feature_values, self._statistics[rows], numeric=is_numeric(feature_values[0]))
+            if impurity > largest_impurity:
+                largest_impurity = impurity
+                best_criteria = {"feature_i": feature_i, "threshold": threshold}
+        return largest_impurity, best_criteria
+
+    def _grow_presorted_tree(self, X, y, start, stop, current_depth=0):
+        """ Recursive method which builds out the decision tree from the presorted features """
+        n_samples = stop - start
+        if n_samples >= self.min_samples_split and current_depth <= self.max_depth:
+            impurity, best_criteria = self._best_presorted_split(X, start, stop)
+            if impurity > self.min_impurity:
+                feature_i, threshold = best_criteria["feature_i"], best_criteria["threshold"]
+                node_index = self._sample_index[start:stop]
+                split = start + self._partition(meets_threshold(X[node_index, feature_i], threshold),
+                                                start, stop)
+                # Stable partition keeps both halves of every sorted row in order
+                for sorted_rows in self._sorted_index[:, start:stop]:
+                    goes_true = meets_threshold(X[sorted_rows, feature_i], threshold)
+                    sorted_rows[:] = np.concatenate((sorted_rows[goes_true], sorted_rows[~goes_true]))
+                true_branch = self._grow_presorted_tree(X, y, start, split, current_depth + 1)
+                false_branch = self._grow_presorted_tree(X, y, split, stop, current_depth + 1)
+                return DecisionNode(feature_i=int(feature_i), threshold=threshold,
+                                    true_branch=true_branch, false_branch=false_branch)
+
+        # We're at leaf => determine value
+        return self._leaf(y, start, stop)
+
+    def _histogram(self, idx):
+        """ Sum the statistics of the samples idx per (feature, bin) """
+        n_features = len(self._bin_offsets)
+        if len(self._code_columns) == self._codes.shape[1]:
+            codes = self._codes[idx]
+        else:
+            codes = self._codes[np.ix_(idx, self._code_columns)]
+        flat_codes = (codes + self._bin_offsets).ravel()
+        statistics = self._statistics[idx]
+        histogram = np.empty((n_features * self._n_bins, statistics.shape[1]))
+        for s in range(statistics.shape[1]):
+            weights = np.repeat(statistics[:, s], n_features)
+            histogram[:, s] = np.bincount(flat_codes, weights=weights,
+                                          minlength=len(histogram))
+        return histogram.reshape(n_features, self._n_bins, -1)
+
+    def _best_hist_split(self, histogram):
+        """ Score every bin boundary of every feature in one pass. Samples in bins >= b
+        go to the true branch, which matches the 'value >= threshold' rule used in predict.
+        Constant features have a single bin and no boundary to split on. """
+        if histogram.shape[1] < 2:
+            return -np.inf, 0, 0
+        total = histogram[0].sum(axis=0)
+        false_stats = np.cumsum(histogram, axis=1)[:, :-1]
+        true_stats = total - false_stats
+        with np.errstate(divide="ignore", invalid="ignore"):
+            impurity = self._statistics_impurity(total, true_stats, false_stats)
+        valid = (true_stats[..., 0] > 0) & (false_stats[..., 0] > 0)
+        impurity = np.where(valid & ~np.isnan(impurity), impurity, -np.inf)
+        feature_i, bin_i = np.unravel_index(np.argmax(impurity), impurity.shape)
+        return impurity[feature_i, bin_i], int(feature_i), int(bin_i) + 1
+
+    def _split_hist_node(self, start, stop, histogram, column_i, bin_i):
+        """ Partition the node on the bin boundary and return the split position and the
+        histograms of the two children. Only the smaller child is summed, the histogram of
+        its sibling is the parent's histogram minus it. """
+        node_index = self._sample_index[start:stop]
+        goes_true = self._codes[node_index, self._code_columns[column_i]] >= bin_i
+        split = start + self._partition(goes_true, start, stop)
+        if split - start <= stop - split:
+            true_histogram = self._histogram(self._sample_index[start:split])
+            false_histogram = histogram - true_histogram
+        else:
+            false_histogram = self._histogram(self._sample_index[split:stop])
+            true_histogram = histogram - false_histogram
+        return split, true_histogram, false_histogram
+
+    def _hist_node(self, column_i, bin_i, true_branch=None, false_branch=None):
+        threshold = self._bin_edges[self._code_columns[column_i]][bin_i - 1]
+        return DecisionNode(feature_i=int(self._feature_index[column_i]), threshold=threshold,
+                            true_branch=true_branch, false_branch=false_branch)
+
+    def _grow_hist_tree(self, y, start, stop, histogram, current_depth=0):
+        """ Recursive method which builds out the decision tree from the binned features """
+        if stop - start >= self.min_samples_split and current_depth <= self.max_depth:
+            impurity, column_i, bin_i = self._best_hist_split(histogram)
+            if impurity > self.min_impurity:
+                split, true_histogram, false_histogram = self._split_hist_node(
+                    start, stop, histogram, column_i, bin_i)
+                true_branch = self._grow_hist_tree(y, start, split, true_histogram, current_depth + 1)
+                false_branch = self._grow_hist_tree(y, split, stop, false_histogram, current_depth + 1)
+                return self._hist_node(column_i, bin_i, true_branch, false_branch)
+
+        # We're at leaf => determine value
+        return self._leaf(y, start, stop)
+
+    def _grow_hist_tree_leaf_wise(self, y, root_histogram):
+        """ Grow the tree by always splitting the leaf with the largest impurity decrease
+        until there are max_leaves leaves """
+        # Leaves as [start, stop, depth, parent, is_true_branch]. Parent None is the root.
+        leaves = []
+        candidates = []     # Heap of (-impurity, leaf id, histogram, column_i, bin_i)
+
+        def add_leaf(start, stop, depth, histogram, parent, is_true_branch):
+            leaves.append([start, stop, depth, parent, is_true_branch])
+            if stop - start >= self.min_samples_split and depth <= self.max_depth:
+                impurity, column_i, bin_i = self._best_hist_split(histogram)
+                if impurity > self.min_impurity:
+                    heapq.heappush(candidates, (-impurity, len(leaves) - 1, histogram, column_i, bin_i))
+
+        add_leaf(0, len(self._sample_index), 0, root_histogram, None, None)
+        root = None
+        n_leaves = 1
+        while candidates and n_leaves < self.max_leaves:
+            _, leaf_i, histogram, column_i, bin_i = heapq.heappop(candidates)
+            start, stop, depth, parent, is_true_branch = leaves[leaf_i]
+            node = self._hist_node(column_i, bin_i)
+            if parent is None:
+                root = node
+            elif is_true_branch:
+                parent.true_branch = node
+            else:
+                parent.false_branch = node
+            leaves[leaf_i] = None
+            split, true_histogram, false_histogram = self._split_hist_node(
+                start, stop, histogram, column_i, bin_i)
+            add_leaf(start, split, depth + 1, true_histogram, node, True)
+            add_leaf(split, stop, depth + 1, false_histogram, node, False)
+            n_leaves += 1
+
+        # Determine the values of the leaves that were not split
+        for leaf in leaves:
+            if leaf is None:
+                continue
+            start, stop, _, parent, is_true_branch = leaf
+            node = self._leaf(y, start, stop)
+            if parent is None:
+                root = node
+            elif is_true_branch:
+                parent.true_branch = node
+            else:
+                parent.false_branch = node
+        return root
+
 
     def predict_value(self, x, tree=None):
-        """ Do a recursive search down the tree and make a prediction of the data sample by the
+        """ Walk down the tree and make a prediction of the data sample by the
             value of the leaf that we end up at """
 
         if tree is None:
             tree = self.root
 
         # If we have a value (i.e we're at a leaf) => return value as the prediction
-        if tree.value is not None:
-            return tree.value
+        while tree.value is None:
+            # Choose the feature that we will test
+            feature_value = x[tree.feature_i]
 
-        # Choose the feature that we will test
-        feature_value = x[tree.feature_i]
-
-        # Determine if we will follow left or right branch
-        branch = tree.false_branch
-        if isinstance(feature_value, int) or isinstance(feature_value, float):
-            if feature_value >= tree.threshold:
+            # Determine if we will follow left or right branch
+            branch = tree.false_branch
+            if meets_threshold(feature_value, tree.threshold):
                 branch = tree.true_branch
-        elif feature_value == tree.threshold:
-            branch = tree.true_branch
 
-        # Test subtree
-        return self.predict_value(x, branch)
+            # Test subtree
+            tree = branch
+
+        return tree.value
 
     def predict(self, X):
-        """ Classify samples one by one and return the set of labels """
+        """ Predict the whole batch X with the array representation of the tree. Falls back
+        to classifying samples one by one if X holds values that are not numbers. """
+        X = np.asarray(X)
+        if self.flat_tree.supports(X):
+            return self.flat_tree.predict(X)
         y_pred = [self.predict_value(sample) for sample in X]
         return y_pred
 
@@ -199,21 +611,15 @@ class XGBoostRegressionTree(DecisionTree):
         y, y_pred = y[:, :col], y[:, col:]
         return y, y_pred
 
-    def _gain(self, y, y_pred):
-        nominator = np.power((y * self.loss.gradient(y, y_pred)).sum(), 2)
-        denominator = self.loss.hess(y, y_pred).sum()
-        return 0.5 * (nominator / denominator)
-
-    def _gain_by_taylor(self, y, y1, y2):
-        # Split
+    def _taylor_statistics(self, y):
         y, y_pred = self._split(y)
-        y1, y1_pred = self._split(y1)
-        y2, y2_pred = self._split(y2)
+        gradient = np.sum(y * self.loss.gradient(y, y_pred), axis=1, keepdims=True)
+        hessian = np.sum(self.loss.hess(y, y_pred), axis=1, keepdims=True)
+        return np.concatenate((gradient, hessian), axis=1)
 
-        true_gain = self._gain(y1, y1_pred)
-        false_gain = self._gain(y2, y2_pred)
-        gain = self._gain(y, y_pred)
-        return true_gain + false_gain - gain
+    def _gain_by_taylor_statistics(self, total, true_stats, false_stats):
+        gain = lambda s: 0.5 * np.power(s[..., 1], 2) / s[..., 2]
+        return gain(true_stats) + gain(false_stats) - gain(total)
 
     def _approximate_update(self, y):
         # y split into y, y_pred
@@ -225,57 +631,112 @@ class XGBoostRegressionTree(DecisionTree):
 
         return update_approximation
 
-    def fit(self, X, y):
-        self._impurity_calculation = self._gain_by_taylor
+    def fit(self, X, y, sample_index=None, feature_index=None, binned=None):
         self._leaf_value_calculation = self._approximate_update
-        super(XGBoostRegressionTree, self).fit(X, y)
+        self._split_statistics = self._taylor_statistics
+        self._statistics_impurity = self._gain_by_taylor_statistics
+        super(XGBoostRegressionTree, self).fit(X, y, sample_index=sample_index,
+                                               feature_index=feature_index, binned=binned)
 
 
-class RegressionTree(DecisionTree):
-    def _calculate_variance_reduction(self, y, y1, y2):
-        var_tot = calculate_variance(y)
-        var_1 = calculate_variance(y1)
-        var_2 = calculate_variance(y2)
-        frac_1 = len(y1) / len(y)
-        frac_2 = len(y2) / len(y)
+class GradientHessianTree(DecisionTree):
+    """Multi-output regression tree for Newton boosting. y holds the gradient of every
+    output in its left half and the hessian in its right half. All outputs share the
+    splits, which are scored by the second order gain summed over the outputs, so a single
+    tree per round serves every class of a multiclass model.
+
+    Parameters:
+    -----------
+    reg_lambda: float
+        L2 regularization of the leaf values. Keeps leaves with tiny hessians finite.
+    All other parameters are the ones of DecisionTree.
+    """
+    def __init__(self, min_samples_split=2, min_impurity=1e-7, max_depth=float("inf"),
+                 loss=None, splitter="best", max_bins=255, max_leaves=None, reg_lambda=1.0):
+        self.reg_lambda = reg_lambda
+        super(GradientHessianTree, self).__init__(min_samples_split=min_samples_split,
+            min_impurity=min_impurity, max_depth=max_depth, loss=loss,
+            splitter=splitter, max_bins=max_bins, max_leaves=max_leaves)
+
+    def _gradient_statistics(self, y):
+        # Gradients and hessians are summable as they are
+        return y
+
+    def _gain_by_taylor(self, total, true_stats, false_stats):
+        n_outputs = (total.shape[-1] - 1) // 2
+        def gain(s):
+            gradient, hessian = s[..., 1:n_outputs + 1], s[..., n_outputs + 1:]
+            return 0.5 * np.sum(np.power(gradient, 2) / (hessian + self.reg_lambda), axis=-1)
+        return gain(true_stats) + gain(false_stats) - gain(total)
+
+    def _newton_step(self, y):
+        n_outputs = np.shape(y)[1] // 2
+        gradient = np.sum(y[:, :n_outputs], axis=0)
+        hessian = np.sum(y[:, n_outputs:], axis=0)
+        value = gradient / (hessian + self.reg_lambda)
+        return value if len(value) > 1 else value[0]
+
+    def fit(self, X, y, sample_index=None, feature_index=None, binned=None):
+        self._leaf_value_calculation = self._newton_step
+        self._split_statistics = self._gradient_statistics
+        self._statistics_impurity = self._gain_by_taylor
+        super(GradientHessianTree, self).fit(X, y, sample_index=sample_index,
+                                             feature_index=feature_index, binned=binned)
 
-        # Calculate the variance reduction
-        variance_reduction = var_tot - (frac_1 * var_1 + frac_2 * var_2)
 
-        return sum(variance_reduction)
+class RegressionTree(DecisionTree):
+    def _moment_statistics(self, y):
+        # Variance does not change with a shift. Centering keeps the sum of squares accurate.
+        y = y - np.mean(y, axis=0)
+        return np.concatenate((y, np.power(y, 2)), axis=1)
+
+    def _calculate_variance_reduction(self, total, true_stats, false_stats):
+        return impurity_decrease(total, true_stats, false_stats, variance)
 
     def _mean_of_y(self, y):
         value = np.mean(y, axis=0)
         return value if len(value) > 1 else value[0]
 
-    def fit(self, X, y):
-        self._impurity_calculation = self._calculate_variance_reduction
+    def fit(self, X, y, sample_index=None, feature_index=None, binned=None):
         self._leaf_value_calculation = self._mean_of_y
-        super(RegressionTree, self).fit(X, y)
+        self._split_statistics = self._moment_statistics
+        self._statistics_impurity = self._calculate_variance_reduction
+        super(RegressionTree, self).fit(X, y, sample_index=sample_index,
+                                        feature_index=feature_index, binned=binned)
 
 class ClassificationTree(DecisionTree):
-    def _calculate_information_gain(self, y, y1, y2):
-        # Calculate information gain
-        p = len(y1) / len(y)
-        entropy = calculate_entropy(y)
-        info_gain = entropy - p * \
-            calculate_entropy(y1) - (1 - p) * \
-            calculate_entropy(y2)
+    """Decision tree classifier.
 
-        return info_gain
+    Parameters:
+    -----------
+    criterion: string
+        Impurity measure of the splits. Either 'entropy' (information gain) or 'gini'.
+    All other parameters are the ones of DecisionTree.
+    """
+    def __init__(self, min_samples_split=2, min_impurity=1e-7, max_depth=float("inf"),
+                 loss=None, splitter="best", max_bins=255, max_leaves=None, criterion="entropy"):
+        if criterion not in ("entropy", "gini"):
+            raise ValueError("Unknown criterion '%s'" % criterion)
+        self.criterion = criterion
+        super(ClassificationTree, self).__init__(min_samples_split=min_samples_split,
+            min_impurity=min_impurity, max_depth=max_depth, loss=loss,
+            splitter=splitter, max_bins=max_bins, max_leaves=max_leaves)
+
+    def _calculate_information_gain(self, total, true_stats, false_stats):
+        impurity = gini if self.criterion == "gini" else entropy
+        return impurity_decrease(total, true_stats, false_stats, impurity)
+
+    def _class_count_statistics(self, y):
+        _, label_i = np.unique(y, return_inverse=True)
+        return np.eye(label_i.max() + 1)[label_i.ravel()]
 
     def _majority_vote(self, y):
-        most_common = None
-        max_count = 0
-        for label in np.unique(y):
-            # Count number of occurences of samples with label
-            count = len(y[y == label])
-            if count > max_count:
-                most_common = label
-                max_count = count
-        return most_common
-
-    def fit(self, X, y):
-        self._impurity_calculation = self._calculate_information_gain
+        labels, counts = np.unique(y, return_counts=True)
+        return labels[np.argmax(counts)]
+
+    def fit(self, X, y, sample_index=None, feature_index=None, binned=None):
         self._leaf_value_calculation = self._majority_vote
-        super(ClassificationTree, self).fit(X, y)
+        self._split_statistics = self._class_count_statistics
+        self._statistics_impurity = self._calculate_information_gain
+        super(ClassificationTree, self).fit(X, y, sample_index=sample_index,
+                                            feature_index=feature_index, binned=binned)
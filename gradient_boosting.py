@@ -5,15 +5,17 @@ import progressbar
 # Import helper functions
 from mlfromscratch.utils import train_test_split, standardize, to_categorical
 from mlfromscratch.utils import mean_squared_error, accuracy_score
-from mlfromscratch.deep_learning.loss_functions import SquareLoss, CrossEntropy
-from mlfromscratch.supervised_learning.decision_tree import RegressionTree
+from mlfromscratch.deep_learning.loss_functions import SquareLoss, SoftmaxCrossEntropy
+from mlfromscratch.supervised_learning.decision_tree import RegressionTree, GradientHessianTree
+from mlfromscratch.supervised_learning.decision_tree import bin_features
 from mlfromscratch.utils.misc import bar_widgets
 
 
 class GradientBoosting(object):
     """Super class of GradientBoostingClassifier and GradientBoostinRegressor. 
     Uses a collection of regression trees that trains on predicting the gradient
-    of the loss function. 
+    of the loss function. For classification every tree predicts a Newton step for
+    all classes at once, from the gradient and hessian of the softmax cross entropy.
 
     Parameters:
     -----------
@@ -30,80 +32,217 @@ class GradientBoosting(object):
         The maximum depth of a tree.
     regression: boolean
         True or false depending on if we're doing regression or classification.
+    splitter: string
+        Split search of the regression trees. With 'hist' X is binned once for all trees
+        and child histograms are derived by subtracting the sibling from the parent.
+    max_bins: int
+        The maximum number of bins per feature when splitter is 'hist'.
+    max_leaves: int
+        If set (splitter 'hist' only) trees are grown leaf-wise up to max_leaves leaves.
+    subsample: float
+        The fraction of the samples (drawn without replacement) that each tree is fit on.
+    colsample: float
+        The fraction of the features that each tree may split on.
+    early_stopping_rounds: int
+        If set, training stops when the validation loss (or, without validation data, the
+        out-of-bag loss improvement) has not improved for this many rounds, and the
+        ensemble is cut off at the best round (n_trees).
+    validation_data: tuple
+        A tuple containing validation data and labels (X, y)
+    seed: int
+        Seed of the row and column sampling.
     """
     def __init__(self, n_estimators, learning_rate, min_samples_split,
-                 min_impurity, max_depth, regression):
+                 min_impurity, max_depth, regression, splitter="best", max_bins=255,
+                 max_leaves=None, subsample=1.0, colsample=1.0, early_stopping_rounds=None,
+                 validation_data=None, seed=None):
         self.n_estimators = n_estimators
         self.learning_rate = learning_rate
         self.min_samples_split = min_samples_split
         self.min_impurity = min_impurity
         self.max_depth = max_depth
         self.regression = regression
+        self.splitter = splitter
+        self.max_bins = max_bins
+        self.subsample = subsample
+        self.colsample = colsample
+        self.early_stopping_rounds = early_stopping_rounds
+        self.seed = seed
         self.bar = progressbar.ProgressBar(widgets=bar_widgets)
         
         # Square loss for regression
-        # Log loss for classification
+        # Log loss of the softmax over the class scores for classification
         self.loss = SquareLoss()
         if not self.regression:
-            self.loss = CrossEntropy()
+            self.loss = SoftmaxCrossEntropy()
+
+        self.val_set = None
+        if validation_data:
+            X, y = validation_data
+            self.val_set = {"X": X, "y": y}
+        if early_stopping_rounds and self.val_set is None and subsample >= 1:
+            raise ValueError("early_stopping_rounds needs validation_data or subsample < 1")
+        # Loss per round used for early stopping (validation or out-of-bag)
+        self.errors = {"validation": [], "oob_improvement": []}
+
+        # Number of trees used in predict. Early stopping lowers it to the best round.
+        self.n_trees = n_estimators
 
         # Initialize regression trees
+        Tree = RegressionTree if self.regression else GradientHessianTree
         self.trees = []
         for _ in range(n_estimators):
-            tree = RegressionTree(
+            tree = Tree(
                     min_samples_split=self.min_samples_split,
                     min_impurity=min_impurity,
-                    max_depth=self.max_depth)
+                    max_depth=self.max_depth,
+                    splitter=splitter,
+                    max_bins=max_bins,
+                    max_leaves=max_leaves)
             self.trees.append(tree)
 
 
     def fit(self, X, y):
-        y_pred = np.full(np.shape(y), np.mean(y, axis=0))
+        n_samples, n_features = np.shape(X)
+        rng = np.random.default_rng(self.seed)
+        self.initial_prediction = self._initial_prediction(y)
+        y_pred = np.full(np.shape(y), self.initial_prediction)
+        if self.val_set is not None:
+            val_pred = np.full(np.shape(self.val_set["y"]), self.initial_prediction)
+        self.errors = {"validation": [], "oob_improvement": []}
+        self.n_trees = self.n_estimators
+        # A bar left unfinished by early stopping can not be iterated again
+        self.bar = progressbar.ProgressBar(widgets=bar_widgets)
+        best_score, best_round = np.inf, 0
+        # Partition buffer shared by all trees. Each tree only reorders it in place.
+        sample_index = np.arange(n_samples)
+        n_rows = max(1, int(round(self.subsample * n_samples)))
+        n_columns = max(1, int(round(self.colsample * n_features)))
+        if self.early_stopping_rounds and self.val_set is None and n_rows == n_samples:
+            raise ValueError("subsample=%s leaves no out-of-bag samples of %d for early stopping"
+                             % (self.subsample, n_samples))
+        binned = bin_features(X, self.max_bins) if self.splitter == "hist" else None
         for i in self.bar(range(self.n_estimators)):
-            gradient = self.loss.gradient(y, y_pred)
-            self.trees[i].fit(X, gradient)
-            update = self.trees[i].predict(X)
-            # Update y prediction
-            y_pred -= np.multiply(self.learning_rate, update)
+            gradient = self._tree_targets(y, y_pred)
+            feature_index = None
+            if n_columns < n_features:
+                feature_index = np.sort(rng.choice(n_features, size=n_columns, replace=False))
+            if n_rows < n_samples:
+                rng.shuffle(sample_index)
+            # First n_rows of the shuffled buffer are in-bag, the rest are out-of-bag
+            in_bag, out_of_bag = sample_index[:n_rows], sample_index[n_rows:]
+            self.trees[i].fit(X, gradient, sample_index=in_bag, feature_index=feature_index,
+                              binned=binned)
+            # Update y prediction in place from the leaf each sample ended up in
+            for start, stop, update in self.trees[i].leaf_slices:
+                y_pred[in_bag[start:stop]] -= np.multiply(self.learning_rate, update)
+            if len(out_of_bag) > 0:
+                oob_loss = np.mean(self.loss.loss(y[out_of_bag], y_pred[out_of_bag]))
+                update = np.multiply(self.learning_rate, self.trees[i].predict(X[out_of_bag]))
+                y_pred[out_of_bag] -= update
+                improvement = oob_loss - np.mean(self.loss.loss(y[out_of_bag], y_pred[out_of_bag]))
+                self.errors["oob_improvement"].append(improvement)
 
+            if not self.early_stopping_rounds:
+                continue
+            if self.val_set is not None:
+                val_pred -= np.multiply(self.learning_rate, self.trees[i].predict(self.val_set["X"]))
+                score = np.mean(self.loss.loss(self.val_set["y"], val_pred))
+                self.errors["validation"].append(score)
+            else:
+                score = -np.sum(self.errors["oob_improvement"])
+            if score < best_score:
+                best_score, best_round = score, i
+            elif i - best_round >= self.early_stopping_rounds:
+                break
 
-    def predict(self, X):
-        y_pred = np.array([])
+        if self.early_stopping_rounds:
+            # Predict with the trees up to and including the best round
+            self.n_trees = best_round + 1
+
+
+    def _initial_prediction(self, y):
+        return np.mean(y, axis=0)
+
+    def _tree_targets(self, y, y_pred):
+        """ What the trees are fit on: the gradient of the loss """
+        return self.loss.gradient(y, y_pred)
+
+    def _raw_predict(self, X):
+        y_pred = np.full((np.shape(X)[0],) + np.shape(self.initial_prediction), self.initial_prediction)
         # Make predictions
-        for tree in self.trees:
-            update = tree.predict(X)
-            update = np.multiply(self.learning_rate, update)
-            y_pred = -update if not y_pred.any() else y_pred - update
+        for tree in self.trees[:self.n_trees]:
+            y_pred -= np.multiply(self.learning_rate, tree.predict(X))
+        return y_pred
+
+    def predict(self, X):
+        y_pred = self._raw_predict(X)
 
         if not self.regression:
-            # Turn into probability distribution
-            y_pred = np.exp(y_pred) / np.expand_dims(np.sum(np.exp(y_pred), axis=1), axis=1)
-            # Set label to the value that maximizes probability
+            # Set label to the class with the largest score. Softmax keeps the order.
             y_pred = np.argmax(y_pred, axis=1)
         return y_pred
 
 
 class GradientBoostingRegressor(GradientBoosting):
     def __init__(self, n_estimators=200, learning_rate=0.5, min_samples_split=2,
-                 min_var_red=1e-7, max_depth=4, debug=False):
+                 min_var_red=1e-7, max_depth=4, debug=False, splitter="best", max_bins=255,
+                 max_leaves=None, subsample=1.0, colsample=1.0, early_stopping_rounds=None,
+                 validation_data=None, seed=None):
         super(GradientBoostingRegressor, self).__init__(n_estimators=n_estimators, 
             learning_rate=learning_rate, 
             min_samples_split=min_samples_split, 
             min_impurity=min_var_red,
             max_depth=max_depth,
-            regression=True)
+            regression=True,
+            splitter=splitter,
+            max_bins=max_bins,
+            max_leaves=max_leaves,
+            subsample=subsample,
+            colsample=colsample,
+            early_stopping_rounds=early_stopping_rounds,
+            validation_data=validation_data,
+            seed=seed)
 
 class GradientBoostingClassifier(GradientBoosting):
     def __init__(self, n_estimators=200, learning_rate=.5, min_samples_split=2,
-                 min_info_gain=1e-7, max_depth=2, debug=False):
+                 min_info_gain=1e-7, max_depth=2, debug=False, splitter="best", max_bins=255,
+                 max_leaves=None, subsample=1.0, colsample=1.0, early_stopping_rounds=None,
+                 validation_data=None, seed=None):
         super(GradientBoostingClassifier, self).__init__(n_estimators=n_estimators, 
             learning_rate=learning_rate, 
             min_samples_split=min_samples_split, 
             min_impurity=min_info_gain,
             max_depth=max_depth,
-            regression=False)
+            regression=False,
+            splitter=splitter,
+            max_bins=max_bins,
+            max_leaves=max_leaves,
+            subsample=subsample,
+            colsample=colsample,
+            early_stopping_rounds=early_stopping_rounds,
+            validation_data=validation_data,
+            seed=seed)
 
     def fit(self, X, y):
         y = to_categorical(y)
+        if self.val_set is not None and len(np.shape(self.val_set["y"])) == 1:
+            self.val_set["y"] = to_categorical(self.val_set["y"], n_col=np.shape(y)[1])
         super(GradientBoostingClassifier, self).fit(X, y)
 
+    def _initial_prediction(self, y):
+        # Log of the class priors
+        return np.log(np.clip(np.mean(y, axis=0), 1e-15, None))
+
+    def _tree_targets(self, y, y_pred):
+        # Gradients and hessians of all classes go to one tree
+        p = self.loss.softmax(y_pred)
+        return np.concatenate((p - y, p * (1 - p)), axis=1)
+
+    def predict_log_proba(self, X):
+        """ Log probabilities of the classes, by a numerically stable log-softmax """
+        return self.loss.log_softmax(self._raw_predict(X))
+
+    def predict_proba(self, X):
+        return np.exp(self.predict_log_proba(X))
+
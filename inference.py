@@ -0,0 +1,289 @@
+from __future__ import print_function, division
+import copy
+import numpy as np
+from mlfromscratch.deep_learning.layers import Dense, Conv2D, BatchNormalization, Activation
+from mlfromscratch.deep_learning.layers import Dropout, Flatten, Reshape, image_to_column
+from mlfromscratch.deep_learning.activation_functions import Sigmoid, Softmax, TanH, ReLU, SoftPlus
+
+# Activations that may write their output over their input. The others (ELU, SELU,
+# LeakyReLU) read the input after writing to out.
+_IN_PLACE_ACTIVATIONS = (Sigmoid, Softmax, TanH, ReLU, SoftPlus)
+
+
+class InferenceModel(object):
+    """A frozen copy of a trained NeuralNetwork that only predicts. Created by
+    NeuralNetwork.compile_for_inference.
+
+    BatchNormalization is folded into the weights of the Dense or Conv2D layer before it
+    (or into a scale and shift when there is none), Dropout, which scales by 1 - p outside
+    of training, is folded into the weights next to it and an Activation
+    that can be evaluated in place is applied on the output of the layer before it. The outputs of the layers
+    are written into buffers that are allocated once for max_batch_size samples; larger
+    inputs are predicted in batches of max_batch_size. The buffers are shared between
+    calls, so a model must not be used by several threads at once. The model is picklable
+    (without its buffers, which are allocated again when it is loaded).
+
+    Parameters:
+    -----------
+    ops: list
+        The operations that the layers were compiled into, in order.
+    input_shape: tuple
+        The shape of a sample.
+    output_shape: tuple
+        The shape of the prediction of a sample.
+    max_batch_size: int
+        The number of samples that the buffers are allocated for.
+    dtype: numpy dtype
+        The dtype of the weights and of the values passed between the operations.
+    """
+    def __init__(self, ops, input_shape, output_shape, max_batch_size=256, dtype=np.float64):
+        object.__setattr__(self, "ops", tuple(ops))
+        object.__setattr__(self, "input_shape", tuple(input_shape))
+        object.__setattr__(self, "output_shape", tuple(output_shape))
+        object.__setattr__(self, "max_batch_size", max_batch_size)
+        object.__setattr__(self, "dtype", np.dtype(dtype))
+        self._allocate()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("InferenceModel is immutable")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["buffers"]
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+        self._allocate()
+
+    def _allocate(self):
+        buffers = tuple(op.buffers(self.max_batch_size, self.dtype) for op in self.ops)
+        object.__setattr__(self, "buffers", buffers)
+
+    def nbytes(self):
+        """ The size of the weights and of the preallocated buffers in bytes """
+        return (sum(op.nbytes() for op in self.ops) +
+                sum(buffer.nbytes for buffers in self.buffers for buffer in buffers))
+
+    def predict(self, X):
+        """ The predictions of X, as a new array """
+        n_samples = len(X)
+        y_pred = np.empty((n_samples,) + self.output_shape, dtype=self.dtype)
+        for start in range(0, n_samples, self.max_batch_size):
+            stop = min(start + self.max_batch_size, n_samples)
+            layer_output = np.asarray(X[start:stop], dtype=self.dtype)
+            for op, buffers in zip(self.ops, self.buffers):
+                layer_output = op(layer_output, buffers)
+            y_pred[start:stop] = layer_output
+        return y_pred
+
+    def __call__(self, X):
+        return self.predict(X)
+
+
+def _frozen(array, dtype):
+    array = np.array(array, dtype=dtype)
+    array.flags.writeable = False
+    return array
+
+
+class _DenseOp(object):
+    """ X.dot(W) + bias, followed by an optional activation, into one buffer """
+    def __init__(self, W, bias, n_units, dtype, input_scale=1):
+        self.W = _frozen(np.multiply(W, input_scale), dtype)
+        self.bias = _frozen(bias, dtype)
+        self.n_units = n_units
+        self.activation = None
+
+    def fold(self, scale, shift):
+        self.W = _frozen(self.W * scale, self.W.dtype)
+        self.bias = _frozen(self.bias * scale + shift, self.W.dtype)
+
+    def nbytes(self):
+        return self.W.nbytes + self.bias.nbytes
+
+    def buffers(self, max_batch_size, dtype):
+        return (np.empty((max_batch_size, self.n_units), dtype=dtype),)
+
+    def __call__(self, X, buffers):
+        output = np.dot(X, self.W, out=buffers[0][:len(X)])
+        output += self.bias
+        if self.activation is not None:
+            self.activation(output, out=output)
+        return output
+
+
+class _ConvOp(object):
+    """ Convolution by im2col and a matrix product, followed by an optional activation.
+    A batch normalization is folded into the filters if its scale is constant over the
+    height and width of the output, and is otherwise kept as a scale per output value. """
+    def __init__(self, layer, dtype, input_scale=1):
+        self.filter_shape = layer.filter_shape
+        self.stride = layer.stride
+        self.padding = layer.padding
+        self.output_shape = layer.output_shape()
+        n_filters, out_height, out_width = self.output_shape
+        self.W_col = _frozen(np.multiply(layer.W.reshape((n_filters, -1)), input_scale), dtype)
+        # Bias and scale per (filter, output position), broadcast over the batch
+        self.bias = _frozen(np.broadcast_to(np.reshape(layer.w0, (n_filters, 1, 1)),
+                                            (n_filters, out_height * out_width, 1)), dtype)
+        self.scale = None
+        self.activation = None
+
+    def fold(self, scale, shift):
+        n_filters = self.output_shape[0]
+        scale = np.broadcast_to(scale, self.output_shape).reshape((n_filters, -1, 1))
+        shift = np.broadcast_to(shift, self.output_shape).reshape((n_filters, -1, 1))
+        dtype = self.W_col.dtype
+        self.bias = _frozen(self.bias * scale + shift, dtype)
+        if self.scale is None and np.all(scale == scale[:, :1]):
+            self.W_col = _frozen(self.W_col * scale[:, 0], dtype)
+        else:
+            self.scale = _frozen(scale if self.scale is None else self.scale * scale, dtype)
+
+    def nbytes(self):
+        return self.W_col.nbytes + self.bias.nbytes + (0 if self.scale is None else self.scale.nbytes)
+
+    def buffers(self, max_batch_size, dtype):
+        return (np.empty(np.prod(self.output_shape) * max_batch_size, dtype=dtype),
+                np.empty((max_batch_size,) + self.output_shape, dtype=dtype))
+
+    def __call__(self, X, buffers):
+        batch_size = len(X)
+        n_filters, out_height, out_width = self.output_shape
+        X_col = image_to_column(X, self.filter_shape, stride=self.stride, output_shape=self.padding)
+        cols = buffers[0][:n_filters * out_height * out_width * batch_size].reshape(n_filters, -1)
+        np.dot(self.W_col, X_col, out=cols)
+        cols = cols.reshape(n_filters, out_height * out_width, batch_size)
+        if self.scale is not None:
+            cols *= self.scale
+        cols += self.bias
+        # Batch size first
+        output = buffers[1][:batch_size]
+        np.copyto(output, cols.reshape(self.output_shape + (batch_size,)).transpose(3, 0, 1, 2))
+        if self.activation is not None:
+            self.activation(output, out=output)
+        return output
+
+
+class _ScaleShiftOp(object):
+    """ A batch normalization that could not be folded: X * scale + shift """
+    def __init__(self, scale, shift, output_shape, dtype):
+        self.scale = _frozen(scale, dtype)
+        self.shift = _frozen(shift, dtype)
+        self.output_shape = tuple(output_shape)
+        self.activation = None
+
+    def fold(self, scale, shift):
+        dtype = self.scale.dtype
+        self.shift = _frozen(self.shift * scale + shift, dtype)
+        self.scale = _frozen(self.scale * scale, dtype)
+
+    def nbytes(self):
+        return self.scale.nbytes + self.shift.nbytes
+
+    def buffers(self, max_batch_size, dtype):
+        return (np.empty((max_batch_size,) + self.output_shape, dtype=dtype),)
+
+    def __call__(self, X, buffers):
+        output = np.multiply(X, self.scale, out=buffers[0][:len(X)])
+        output += self.shift
+        if self.activation is not None:
+            self.activation(output, out=output)
+        return output
+
+
+class _ActivationOp(object):
+    """ An activation that does not follow a layer it can be fused into """
+    def __init__(self, activation, output_shape):
+        self.activation = activation
+        self.output_shape = tuple(output_shape)
+
+    def nbytes(self):
+        return 0
+
+    def buffers(self, max_batch_size, dtype):
+        return (np.empty((max_batch_size,) + self.output_shape, dtype=dtype),)
+
+    def __call__(self, X, buffers):
+        return self.activation(X, out=buffers[0][:len(X)])
+
+
+class _ReshapeOp(object):
+    def __init__(self, output_shape):
+        self.output_shape = tuple(output_shape)
+
+    def nbytes(self):
+        return 0
+
+    def buffers(self, max_batch_size, dtype):
+        return ()
+
+    def __call__(self, X, buffers):
+        return X.reshape((len(X),) + self.output_shape)
+
+
+class _LayerOp(object):
+    """ Any other layer, evaluated by its own forward pass in inference mode """
+    def __init__(self, layer):
+        self.layer = copy.deepcopy(layer)
+        self.layer.flat_gradients = None
+        self.layer.set_inference(True)
+
+    def nbytes(self):
+        return sum(np.asarray(getattr(self.layer, name)).nbytes for name in self.layer.parameter_names)
+
+    def buffers(self, max_batch_size, dtype):
+        return ()
+
+    def __call__(self, X, buffers):
+        return self.layer.forward_pass(X, training=False)
+
+
+def compile_layers(layers, dtype=np.float64):
+    """ The operations that the layers of a trained network are compiled into """
+    ops = []
+    # Scale of a Dropout that is folded into the weights of the next layer
+    input_scale = 1
+    for layer in layers:
+        last = ops[-1] if ops else None
+        # An op whose output nothing has been applied to yet
+        fusable = isinstance(last, (_DenseOp, _ConvOp, _ScaleShiftOp)) and last.activation is None
+        if isinstance(layer, Dropout):
+            if fusable:
+                last.fold(1 - layer.p, 0)
+            else:
+                input_scale *= 1 - layer.p
+            continue
+        if isinstance(layer, Dense):
+            ops.append(_DenseOp(layer.W, layer.w0, layer.n_units, dtype, input_scale))
+            input_scale = 1
+            continue
+        if isinstance(layer, Conv2D):
+            ops.append(_ConvOp(layer, dtype, input_scale))
+            input_scale = 1
+            continue
+        if input_scale != 1:
+            ops.append(_ScaleShiftOp(input_scale, 0, layer.input_shape, dtype))
+            input_scale, last, fusable = 1, ops[-1], True
+        if isinstance(layer, BatchNormalization):
+            if layer.running_mean is None:
+                raise ValueError("BatchNormalization has no running statistics before training")
+            scale, shift = layer.fold()
+            if fusable:
+                last.fold(scale, shift)
+            else:
+                ops.append(_ScaleShiftOp(scale, shift, layer.output_shape(), dtype))
+        elif isinstance(layer, Activation):
+            if fusable and isinstance(layer.activation_func, _IN_PLACE_ACTIVATIONS):
+                last.activation = copy.deepcopy(layer.activation_func)
+            else:
+                ops.append(_ActivationOp(copy.deepcopy(layer.activation_func), layer.output_shape()))
+        elif isinstance(layer, (Flatten, Reshape)):
+            ops.append(_ReshapeOp(layer.output_shape()))
+        else:
+            ops.append(_LayerOp(layer))
+    if input_scale != 1:
+        ops.append(_ScaleShiftOp(input_scale, 0, layers[-1].output_shape(), dtype))
+    return ops
@@ -1,13 +1,27 @@
 
 from __future__ import print_function, division
 import math
+import time
+from collections import OrderedDict
 import numpy as np
 import copy
+from numpy.lib.stride_tricks import sliding_window_view
 from mlfromscratch.deep_learning.activation_functions import Sigmoid, ReLU, SoftPlus, LeakyReLU
 from mlfromscratch.deep_learning.activation_functions import TanH, ELU, SELU, Softmax
 
 
 class Layer(object):
+    # dtype of the parameters and of the values passed between layers. NeuralNetwork sets
+    # it before the layer is initialized.
+    dtype = np.float64
+    # Names of the trainable parameter attributes. Each has an optimizer <name>_opt.
+    parameter_names = ()
+    # Views into the flat gradient buffer of a NeuralNetwork with a fused optimizer
+    flat_gradients = None
+    # Attributes the forward pass keeps for the backward pass
+    backward_state = ()
+    # Set by NeuralNetwork.inference(). The layer is only used for predictions.
+    inference = False
 
     def set_input_shape(self, shape):
         """ Sets the shape that the layer expects of the input in the forward
@@ -23,7 +37,8 @@ class Layer(object):
         return 0
 
     def forward_pass(self, X, training):
-        """ Propogates the signal forward in the network """
+        """ Propogates the signal forward in the network. Only with training=True the
+        layer keeps what its backward pass needs. """
         raise NotImplementedError()
 
     def backward_pass(self, accum_grad):
@@ -37,6 +52,21 @@ class Layer(object):
         """ The shape of the output produced by forward_pass """
         raise NotImplementedError()
 
+    def set_inference(self, inference):
+        """ Enter or leave inference mode. Entering drops the state kept for backprop. """
+        self.inference = inference
+        if inference:
+            for name in self.backward_state:
+                setattr(self, name, None)
+
+    def _update_parameter(self, name, grad):
+        """ Update the parameter with its optimizer. With a fused optimizer the gradient is
+        instead written to the flat gradient buffer, which the network steps once per batch. """
+        if self.flat_gradients is not None and name in self.flat_gradients:
+            self.flat_gradients[name][...] = grad
+        else:
+            setattr(self, name, getattr(self, name + "_opt").update(getattr(self, name), grad))
+
 
 class Dense(Layer):
     """A fully-connected NN layer.
@@ -49,6 +79,9 @@ class Dense(Layer):
         the number of features of the input. Must be specified if it is the first layer in
         the network.
     """
+    parameter_names = ("W", "w0")
+    backward_state = ("layer_input",)
+
     def __init__(self, n_units, input_shape=None):
         self.layer_input = None
         self.input_shape = input_shape
@@ -60,8 +93,8 @@ class Dense(Layer):
     def initialize(self, optimizer):
         # Initialize the weights
         limit = 1 / math.sqrt(self.input_shape[0])
-        self.W  = np.random.uniform(-limit, limit, (self.input_shape[0], self.n_units))
-        self.w0 = np.zeros((1, self.n_units))
+        self.W  = np.random.uniform(-limit, limit, (self.input_shape[0], self.n_units)).astype(self.dtype)
+        self.w0 = np.zeros((1, self.n_units), dtype=self.dtype)
         # Weight optimizers
         self.W_opt  = copy.copy(optimizer)
         self.w0_opt = copy.copy(optimizer)
@@ -70,7 +103,8 @@ class Dense(Layer):
         return np.prod(self.W.shape) + np.prod(self.w0.shape)
 
     def forward_pass(self, X, training=True):
-        self.layer_input = X
+        if training:
+            self.layer_input = X
         return X.dot(self.W) + self.w0
 
     def backward_pass(self, accum_grad):
@@ -83,8 +117,8 @@ class Dense(Layer):
             grad_w0 = np.sum(accum_grad, axis=0, keepdims=True)
 
             # Update the layer weights
-            self.W = self.W_opt.update(self.W, grad_w)
-            self.w0 = self.w0_opt.update(self.w0, grad_w0)
+            self._update_parameter("W", grad_w)
+            self._update_parameter("w0", grad_w0)
 
         # Return accumulated gradient for next layer
         # Calculated based on the weights used during the forward pass
@@ -115,6 +149,9 @@ class RNN(Layer):
     Reference:
     http://www.wildml.com/2015/09/recurrent-neural-networks-tutorial-part-2-implementing-a-language-model-rnn-with-python-numpy-and-theano/
     """
+    parameter_names = ("U", "V", "W")
+    backward_state = ("layer_input", "state_input", "states", "outputs")
+
     def __init__(self, n_units, activation='tanh', bptt_trunc=5, input_shape=None):
         self.input_shape = input_shape
         self.n_units = n_units
@@ -129,10 +166,10 @@ class RNN(Layer):
         timesteps, input_dim = self.input_shape
         # Initialize the weights
         limit = 1 / math.sqrt(input_dim)
-        self.U  = np.random.uniform(-limit, limit, (self.n_units, input_dim))
+        self.U  = np.random.uniform(-limit, limit, (self.n_units, input_dim)).astype(self.dtype)
         limit = 1 / math.sqrt(self.n_units)
-        self.V = np.random.uniform(-limit, limit, (input_dim, self.n_units))
-        self.W  = np.random.uniform(-limit, limit, (self.n_units, self.n_units))
+        self.V = np.random.uniform(-limit, limit, (input_dim, self.n_units)).astype(self.dtype)
+        self.W  = np.random.uniform(-limit, limit, (self.n_units, self.n_units)).astype(self.dtype)
         # Weight optimizers
         self.U_opt  = copy.copy(optimizer)
         self.V_opt = copy.copy(optimizer)
@@ -142,55 +179,75 @@ class RNN(Layer):
         return np.prod(self.W.shape) + np.prod(self.U.shape) + np.prod(self.V.shape)
 
     def forward_pass(self, X, training=True):
-        self.layer_input = X
         batch_size, timesteps, input_dim = X.shape
 
-        # Save these values for use in backprop.
-        self.state_input = np.zeros((batch_size, timesteps, self.n_units))
-        self.states = np.zeros((batch_size, timesteps+1, self.n_units))
-        self.outputs = np.zeros((batch_size, timesteps, input_dim))
+        # Save these values for use in backprop. The buffers are reused between training
+        # batches of the same shape.
+        shapes = {"state_input": (batch_size, timesteps, self.n_units),
+                  "states": (batch_size, timesteps+1, self.n_units),
+                  "outputs": (batch_size, timesteps, input_dim)}
+        buffers = {}
+        for name, shape in shapes.items():
+            buffer = getattr(self, name, None) if training else None
+            if buffer is None or buffer.shape != shape or buffer.dtype != self.dtype:
+                buffer = np.empty(shape, dtype=self.dtype)
+            buffers[name] = buffer
+        state_input, states, outputs = buffers["state_input"], buffers["states"], buffers["outputs"]
+        if training:
+            self.layer_input = X
+            self.state_input, self.states, self.outputs = state_input, states, outputs
 
         # Set last time step to zero for calculation of the state_input at time step zero
-        self.states[:, -1] = np.zeros((batch_size, self.n_units))
+        states[:, -1] = 0
+        # The input part of the state input of all time steps at once
+        np.matmul(X, self.U.T, out=state_input)
         for t in range(timesteps):
             # Input to state_t is the current input and output of previous states
-            self.state_input[:, t] = X[:, t].dot(self.U.T) + self.states[:, t-1].dot(self.W.T)
-            self.states[:, t] = self.activation(self.state_input[:, t])
-            self.outputs[:, t] = self.states[:, t].dot(self.V.T)
+            state_input[:, t] += states[:, t-1].dot(self.W.T)
+            self.activation(state_input[:, t], out=states[:, t])
+        np.matmul(states[:, :timesteps], self.V.T, out=outputs)
 
-        return self.outputs
+        return outputs
 
     def backward_pass(self, accum_grad):
-        _, timesteps, _ = accum_grad.shape
+        batch_size, timesteps, _ = accum_grad.shape
+        states = self.states[:, :timesteps]
 
-        # Variables where we save the accumulated gradient w.r.t each parameter
+        # Derivative of the activation at every time step, from the cached states
+        activation_grad = self.activation.gradient(self.state_input, output=states)
+
+        grad_V = np.tensordot(accum_grad, states, axes=((0, 1), (0, 1)))
+        # Gradient w.r.t the state input of every time step
+        grad_wrt_state = np.matmul(accum_grad, self.V) * activation_grad
+        # Gradient w.r.t the layer input.
+        # Will be passed on to the previous layer in the network
+        accum_grad_next = np.matmul(grad_wrt_state, self.U)
+
+        # Back Propagation Through Time, for all time steps at once. After k steps back
+        # grad_wrt_state[j] is the gradient w.r.t the state input of time step j that
+        # came from the loss at time step j + k. Each time step propagates back at most
+        # self.bptt_trunc time steps. Time major copies make every time window a
+        # contiguous block, so each step is one matrix product per gradient.
+        grad_wrt_state = np.ascontiguousarray(grad_wrt_state.transpose(1, 0, 2))
+        activation_grad = np.ascontiguousarray(activation_grad.transpose(1, 0, 2))
+        layer_input = np.ascontiguousarray(self.layer_input.transpose(1, 0, 2))
+        states = np.ascontiguousarray(states.transpose(1, 0, 2))
+        n_units, input_dim = self.n_units, layer_input.shape[-1]
         grad_U = np.zeros_like(self.U)
-        grad_V = np.zeros_like(self.V)
         grad_W = np.zeros_like(self.W)
-        # The gradient w.r.t the layer input.
-        # Will be passed on to the previous layer in the network
-        accum_grad_next = np.zeros_like(accum_grad)
-
-        # Back Propagation Through Time
-        for t in reversed(range(timesteps)):
-            # Update gradient w.r.t V at time step t
-            grad_V += accum_grad[:, t].T.dot(self.states[:, t])
-            # Calculate the gradient w.r.t the state input
-            grad_wrt_state = accum_grad[:, t].dot(self.V) * self.activation.gradient(self.state_input[:, t])
-            # Gradient w.r.t the layer input
-            accum_grad_next[:, t] = grad_wrt_state.dot(self.U)
-            # Update gradient w.r.t W and U by backprop. from time step t for at most
-            # self.bptt_trunc number of time steps
-            for t_ in reversed(np.arange(max(0, t - self.bptt_trunc), t+1)):
-                grad_U += grad_wrt_state.T.dot(self.layer_input[:, t_])
-                grad_W += grad_wrt_state.T.dot(self.states[:, t_-1])
-                # Calculate gradient w.r.t previous state
-                grad_wrt_state = grad_wrt_state.dot(self.W) * self.activation.gradient(self.state_input[:, t_-1])
+        for k in range(min(self.bptt_trunc, timesteps - 1) + 1):
+            n = timesteps - k
+            grad_U += grad_wrt_state.reshape(-1, n_units).T.dot(layer_input[:n].reshape(-1, input_dim))
+            # The state before time step zero is zero
+            grad_W += grad_wrt_state[1:].reshape(-1, n_units).T.dot(states[:n-1].reshape(-1, n_units))
+            # Calculate gradient w.r.t previous state
+            grad_wrt_state = grad_wrt_state[1:].reshape(-1, n_units).dot(self.W).reshape(n-1, batch_size, n_units)
+            grad_wrt_state *= activation_grad[:n-1]
 
         # Update weights
-        self.U = self.U_opt.update(self.U, grad_U)
-        self.V = self.V_opt.update(self.V, grad_V)
-        self.W = self.W_opt.update(self.W, grad_W)
+        self._update_parameter("U", grad_U)
+        self._update_parameter("V", grad_V)
+        self._update_parameter("W", grad_W)
 
         return accum_grad_next
 
@@ -216,6 +273,9 @@ class Conv2D(Layer):
     stride: int
         The stride length of the filters during the convolution over the input.
     """
+    parameter_names = ("W", "w0")
+    backward_state = ("layer_input", "X_col", "W_col")
+
     def __init__(self, n_filters, filter_shape, input_shape=None, padding='same', stride=1):
         self.n_filters = n_filters
         self.filter_shape = filter_shape
@@ -229,8 +289,8 @@ class Conv2D(Layer):
         filter_height, filter_width = self.filter_shape
         channels = self.input_shape[0]
         limit = 1 / math.sqrt(np.prod(self.filter_shape))
-        self.W  = np.random.uniform(-limit, limit, size=(self.n_filters, channels, filter_height, filter_width))
-        self.w0 = np.zeros((self.n_filters, 1))
+        self.W  = np.random.uniform(-limit, limit, size=(self.n_filters, channels, filter_height, filter_width)).astype(self.dtype)
+        self.w0 = np.zeros((self.n_filters, 1), dtype=self.dtype)
         # Weight optimizers
         self.W_opt  = copy.copy(optimizer)
         self.w0_opt = copy.copy(optimizer)
@@ -240,14 +300,15 @@ class Conv2D(Layer):
 
     def forward_pass(self, X, training=True):
         batch_size, channels, height, width = X.shape
-        self.layer_input = X
         # Turn image shape into column shape
         # (enables dot product between input and weights)
-        self.X_col = image_to_column(X, self.filter_shape, stride=self.stride, output_shape=self.padding)
+        X_col = image_to_column(X, self.filter_shape, stride=self.stride, output_shape=self.padding)
         # Turn weights into column shape
-        self.W_col = self.W.reshape((self.n_filters, -1))
+        W_col = self.W.reshape((self.n_filters, -1))
+        if training:
+            self.layer_input, self.X_col, self.W_col = X, X_col, W_col
         # Calculate output
-        output = self.W_col.dot(self.X_col) + self.w0
+        output = W_col.dot(X_col) + self.w0
         # Reshape into (n_filters, out_height, out_width, batch_size)
         output = output.reshape(self.output_shape() + (batch_size, ))
         # Redistribute axises so that batch size comes first
@@ -265,8 +326,8 @@ class Conv2D(Layer):
             grad_w0 = np.sum(accum_grad, axis=1, keepdims=True)
 
             # Update the layers weights
-            self.W = self.W_opt.update(self.W, grad_w)
-            self.w0 = self.w0_opt.update(self.w0, grad_w0)
+            self._update_parameter("W", grad_w)
+            self._update_parameter("w0", grad_w0)
 
         # Recalculate the gradient which will be propogated back to prev. layer
         accum_grad = self.W_col.T.dot(accum_grad)
@@ -288,19 +349,24 @@ class Conv2D(Layer):
 
 
 class BatchNormalization(Layer):
-    """Batch normalization.
+    """Batch normalization. In inference mode the normalization with the running
+    statistics is folded into one scale and shift per feature, computed on first use.
     """
+    parameter_names = ("gamma", "beta")
+    backward_state = ("X_centered", "stddev_inv")
+
     def __init__(self, momentum=0.99):
         self.momentum = momentum
         self.trainable = True
         self.eps = 0.01
         self.running_mean = None
         self.running_var = None
+        self.folded = None
 
     def initialize(self, optimizer):
         # Initialize the parameters
-        self.gamma  = np.ones(self.input_shape)
-        self.beta = np.zeros(self.input_shape)
+        self.gamma  = np.ones(self.input_shape, dtype=self.dtype)
+        self.beta = np.zeros(self.input_shape, dtype=self.dtype)
         # parameter optimizers
         self.gamma_opt  = copy.copy(optimizer)
         self.beta_opt = copy.copy(optimizer)
@@ -308,6 +374,17 @@ class BatchNormalization(Layer):
     def parameters(self):
         return np.prod(self.gamma.shape) + np.prod(self.beta.shape)
 
+    def set_inference(self, inference):
+        super(BatchNormalization, self).set_inference(inference)
+        self.folded = None
+
+    def fold(self):
+        """ The scale and shift with which gamma * (X - running_mean) / std + beta
+        equals X * scale + shift """
+        scale = self.gamma / np.sqrt(self.running_var + self.eps)
+        shift = self.beta - self.running_mean * scale
+        return scale.astype(self.dtype, copy=False), shift.astype(self.dtype, copy=False)
+
     def forward_pass(self, X, training=True):
 
         # Initialize running mean and variance if first run
@@ -315,6 +392,14 @@ class BatchNormalization(Layer):
             self.running_mean = np.mean(X, axis=0)
             self.running_var = np.var(X, axis=0)
 
+        if self.inference:
+            if self.folded is None:
+                self.folded = self.fold()
+            scale, shift = self.folded
+            output = X * scale
+            output += shift
+            return output
+
         if training and self.trainable:
             mean = np.mean(X, axis=0)
             var = np.var(X, axis=0)
@@ -324,11 +409,13 @@ class BatchNormalization(Layer):
             mean = self.running_mean
             var = self.running_var
 
-        # Statistics saved for backward pass
-        self.X_centered = X - mean
-        self.stddev_inv = 1 / np.sqrt(var + self.eps)
+        X_centered = X - mean
+        stddev_inv = 1 / np.sqrt(var + self.eps)
+        if training:
+            # Statistics saved for backward pass
+            self.X_centered, self.stddev_inv = X_centered, stddev_inv
 
-        X_norm = self.X_centered * self.stddev_inv
+        X_norm = X_centered * stddev_inv
         output = self.gamma * X_norm + self.beta
 
         return output
@@ -344,8 +431,8 @@ class BatchNormalization(Layer):
             grad_gamma = np.sum(accum_grad * X_norm, axis=0)
             grad_beta = np.sum(accum_grad, axis=0)
 
-            self.gamma = self.gamma_opt.update(self.gamma, grad_gamma)
-            self.beta = self.beta_opt.update(self.beta, grad_beta)
+            self._update_parameter("gamma", grad_gamma)
+            self._update_parameter("beta", grad_beta)
 
         batch_size = accum_grad.shape[0]
 
@@ -363,35 +450,53 @@ class BatchNormalization(Layer):
 
 
 class PoolingLayer(Layer):
-    """A parent class of MaxPooling2D and AveragePooling2D
+    """A parent class of MaxPooling2D and AveragePooling2D. When the stride equals the pool
+    size the windows do not overlap, and the input is pooled as a reshape into blocks
+    followed by a reduction instead of through im2col.
     """
+    backward_state = ("cache",)
+
     def __init__(self, pool_shape=(2, 2), stride=1, padding=0):
         self.pool_shape = pool_shape
         self.stride = stride
         self.padding = padding
         self.trainable = True
 
-    def forward_pass(self, X, training=True):
-        self.layer_input = X
+    def _non_overlapping(self):
+        return tuple(self.pool_shape) == (self.stride, self.stride) and self.padding == 0
 
+    def forward_pass(self, X, training=True):
         batch_size, channels, height, width = X.shape
 
         _, out_height, out_width = self.output_shape()
 
-        X = X.reshape(batch_size*channels, 1, height, width)
-        X_col = image_to_column(X, self.pool_shape, self.stride, self.padding)
+        if self._non_overlapping():
+            pool_height, pool_width = self.pool_shape
+            # (batch_size, channels, out_height, pool_height, out_width, pool_width) view
+            X_blocks = X.reshape(batch_size, channels, out_height, pool_height, out_width, pool_width)
+            output = self._pool_blocks_forward(X_blocks)
+        else:
+            X_col = image_to_column(X.reshape(batch_size*channels, 1, height, width),
+                                    self.pool_shape, self.stride, self.padding)
 
-        # MaxPool or AveragePool specific method
-        output = self._pool_forward(X_col)
+            # MaxPool or AveragePool specific method
+            output = self._pool_forward(X_col)
 
-        output = output.reshape(out_height, out_width, batch_size, channels)
-        output = output.transpose(2, 3, 0, 1)
+            output = output.reshape(out_height, out_width, batch_size, channels)
+            output = output.transpose(2, 3, 0, 1)
 
+        if not training:
+            # Nothing is kept for a backward pass
+            self.cache = None
         return output
 
     def backward_pass(self, accum_grad):
         batch_size, _, _, _ = accum_grad.shape
         channels, height, width = self.input_shape
+        if self._non_overlapping():
+            accum_grad = self._pool_blocks_backward(accum_grad)
+            return accum_grad.reshape((batch_size,) + self.input_shape)
+
         accum_grad = accum_grad.transpose(2, 3, 0, 1).ravel()
 
         # MaxPool or AveragePool specific method
@@ -419,21 +524,47 @@ class MaxPooling2D(PoolingLayer):
         return output
 
     def _pool_backward(self, accum_grad):
-        accum_grad_col = np.zeros((np.prod(self.pool_shape), accum_grad.size))
+        accum_grad_col = np.zeros((np.prod(self.pool_shape), accum_grad.size), dtype=accum_grad.dtype)
         arg_max = self.cache
         accum_grad_col[arg_max, range(accum_grad.size)] = accum_grad
         return accum_grad_col
 
+    def _pool_blocks_forward(self, X_blocks):
+        batch_size, channels, out_height, pool_height, out_width, pool_width = X_blocks.shape
+        # Elements of each block along the last axis, in the same order as in the im2col path
+        windows = X_blocks.transpose(0, 1, 2, 4, 3, 5).reshape(
+            batch_size, channels, out_height, out_width, pool_height * pool_width)
+        arg_max = np.argmax(windows, axis=-1)
+        # Mask of the element of each block that the gradient is routed to
+        self.cache = arg_max[..., np.newaxis] == np.arange(pool_height * pool_width)
+        return np.take_along_axis(windows, arg_max[..., np.newaxis], axis=-1)[..., 0]
+
+    def _pool_blocks_backward(self, accum_grad):
+        batch_size, channels, out_height, out_width = accum_grad.shape
+        pool_height, pool_width = self.pool_shape
+        accum_grad = self.cache * accum_grad[..., np.newaxis]
+        accum_grad = accum_grad.reshape(batch_size, channels, out_height, out_width, pool_height, pool_width)
+        return accum_grad.transpose(0, 1, 2, 4, 3, 5)
+
 class AveragePooling2D(PoolingLayer):
     def _pool_forward(self, X_col):
         output = np.mean(X_col, axis=0)
         return output
 
     def _pool_backward(self, accum_grad):
-        accum_grad_col = np.zeros((np.prod(self.pool_shape), accum_grad.size))
+        accum_grad_col = np.zeros((np.prod(self.pool_shape), accum_grad.size), dtype=accum_grad.dtype)
         accum_grad_col[:, range(accum_grad.size)] = 1. / accum_grad_col.shape[0] * accum_grad
         return accum_grad_col
 
+    def _pool_blocks_forward(self, X_blocks):
+        return X_blocks.mean(axis=(3, 5))
+
+    def _pool_blocks_backward(self, accum_grad):
+        batch_size, channels, out_height, out_width = accum_grad.shape
+        pool_height, pool_width = self.pool_shape
+        accum_grad = accum_grad[:, :, :, np.newaxis, :, np.newaxis] / (pool_height * pool_width)
+        return np.broadcast_to(accum_grad, (batch_size, channels, out_height, pool_height, out_width, pool_width))
+
 
 class ConstantPadding2D(Layer):
     """Adds rows and columns of constant values to the input.
@@ -581,6 +712,8 @@ class Dropout(Layer):
     p: float
         The probability that unit x is set to zero.
     """
+    backward_state = ("_mask",)
+
     def __init__(self, p=0.2):
         self.p = p
         self._mask = None
@@ -621,6 +754,7 @@ class Activation(Layer):
     name: string
         The name of the activation function that will be used.
     """
+    backward_state = ("layer_input", "layer_output", "_output", "_grad")
 
     def __init__(self, name):
         self.activation_name = name
@@ -631,11 +765,27 @@ class Activation(Layer):
         return "Activation (%s)" % (self.activation_func.__class__.__name__)
 
     def forward_pass(self, X, training=True):
+        if not training:
+            return self.activation_func(X)
+        # During training the output and gradient buffers are reused between batches
         self.layer_input = X
-        return self.activation_func(X)
+        self.layer_output = self.activation_func(X, out=self._buffer("_output", X))
+        return self.layer_output
 
     def backward_pass(self, accum_grad):
-        return accum_grad * self.activation_func.gradient(self.layer_input)
+        # The derivative is evaluated from the cached output where the function allows it
+        grad = self.activation_func.gradient(self.layer_input, output=self.layer_output,
+                                             out=self._buffer("_grad", self.layer_input))
+        grad *= accum_grad
+        return grad
+
+    def _buffer(self, name, X):
+        buffer = getattr(self, name, None)
+        dtype = np.result_type(X.dtype, np.float32)
+        if buffer is None or buffer.shape != X.shape or buffer.dtype != dtype:
+            buffer = np.empty(X.shape, dtype=dtype)
+            setattr(self, name, buffer)
+        return buffer
 
     def output_shape(self):
         return self.input_shape
@@ -645,6 +795,9 @@ class Activation(Layer):
 # shape of the filters
 def determine_padding(filter_shape, output_shape="same"):
 
+    # Explicit padding on every side (pooling layers pass their padding as a number)
+    if isinstance(output_shape, int):
+        return (output_shape, output_shape), (output_shape, output_shape)
     # No padding
     if output_shape == "valid":
         return (0, 0), (0, 0)
@@ -666,6 +819,68 @@ def determine_padding(filter_shape, output_shape="same"):
 
 # Reference: CS231n Stanford
 def get_im2col_indices(images_shape, filter_shape, padding, stride=1):
+    # The index arrays only depend on the geometry, so they are shared by all batches and
+    # all layers of the same geometry
+    key = (tuple(images_shape[1:]), tuple(filter_shape), tuple(map(tuple, padding)), stride)
+    return _im2col_cache.get(key, lambda: _im2col_indices(images_shape, filter_shape, padding, stride))
+
+
+class Im2colCache():
+    """ Least recently used cache of the im2col index arrays, keyed by the geometry
+    (image shape without the batch size, filter shape, padding and stride).
+    Counts hits and misses, and estimates the time saved by the hits as the time it
+    took to build the arrays that were hit.
+
+    Parameters:
+    -----------
+    maxsize: int
+        The maximum number of geometries kept.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.tables = OrderedDict()
+        self.reset()
+
+    def reset(self):
+        """ Reset the counters (the cached arrays are kept) """
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0.0
+
+    def get(self, key, build):
+        if key in self.tables:
+            self.tables.move_to_end(key)
+            table, build_time = self.tables[key]
+            self.hits += 1
+            self.time_saved += build_time
+            return table
+        start = time.perf_counter()
+        table = build()
+        self.misses += 1
+        self.tables[key] = (table, time.perf_counter() - start)
+        if len(self.tables) > self.maxsize:
+            self.tables.popitem(last=False)
+        return table
+
+    def info(self):
+        calls = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / calls if calls else 0.0,
+                "time_saved": self.time_saved, "size": len(self.tables), "maxsize": self.maxsize}
+
+_im2col_cache = Im2colCache()
+
+
+def im2col_cache_info(reset=False):
+    """ Counters of the im2col index cache since the last reset: hits, misses, hit_rate,
+    time_saved (seconds), size and maxsize. With reset=True the counters are reset after
+    being read. NeuralNetwork.fit records them per epoch. """
+    info = _im2col_cache.info()
+    if reset:
+        _im2col_cache.reset()
+    return info
+
+def _im2col_indices(images_shape, filter_shape, padding, stride=1):
     # First figure out what the size of the output should be
     batch_size, channels, height, width = images_shape
     filter_height, filter_width = filter_shape
@@ -686,24 +901,45 @@ def get_im2col_indices(images_shape, filter_shape, padding, stride=1):
     return (k, i, j)
 
 
+# Strides for which image_to_column reads the columns from a strided window view of the
+# images and column_to_image accumulates with one strided slice per filter position,
+# instead of gathering and scattering (np.add.at) through the im2col index arrays.
+WINDOW_STRIDES = (1, 2)
+
+
 # Method which turns the image shaped input to column shape.
 # Used during the forward pass.
 # Reference: CS231n Stanford
 def image_to_column(images, filter_shape, stride, output_shape='same'):
-    filter_height, filter_width = filter_shape
-
     pad_h, pad_w = determine_padding(filter_shape, output_shape)
 
     # Add padding to the image
     images_padded = np.pad(images, ((0, 0), (0, 0), pad_h, pad_w), mode='constant')
 
+    if stride in WINDOW_STRIDES:
+        return _image_to_column_windows(images_padded, filter_shape, stride)
+    return _image_to_column_indexed(images_padded, images.shape, filter_shape, (pad_h, pad_w), stride)
+
+
+def _image_to_column_windows(images_padded, filter_shape, stride):
+    filter_height, filter_width = filter_shape
+    channels = images_padded.shape[1]
+    # View of shape (batch_size, channels, out_height, out_width, filter_height, filter_width)
+    windows = sliding_window_view(images_padded, filter_shape, axis=(2, 3))[:, :, ::stride, ::stride]
+    # Rows ordered by (channel, filter row, filter column), columns by (out row, out column, sample)
+    return windows.transpose(1, 4, 5, 2, 3, 0).reshape(filter_height * filter_width * channels, -1)
+
+
+def _image_to_column_indexed(images_padded, images_shape, filter_shape, padding, stride):
+    filter_height, filter_width = filter_shape
+
     # Calculate the indices where the dot products are to be applied between weights
     # and the image
-    k, i, j = get_im2col_indices(images.shape, filter_shape, (pad_h, pad_w), stride)
+    k, i, j = get_im2col_indices(images_shape, filter_shape, padding, stride)
 
     # Get content from image at those indices
     cols = images_padded[:, k, i, j]
-    channels = images.shape[1]
+    channels = images_shape[1]
     # Reshape content into column shape
     cols = cols.transpose(1, 2, 0).reshape(filter_height * filter_width * channels, -1)
     return cols
@@ -718,16 +954,45 @@ def column_to_image(cols, images_shape, filter_shape, stride, output_shape='same
     pad_h, pad_w = determine_padding(filter_shape, output_shape)
     height_padded = height + np.sum(pad_h)
     width_padded = width + np.sum(pad_w)
-    images_padded = np.zeros((batch_size, channels, height_padded, width_padded))
+    padded_shape = (batch_size, channels, height_padded, width_padded)
+
+    if stride in WINDOW_STRIDES:
+        images_padded = _column_to_image_windows(cols, padded_shape, filter_shape, stride)
+    else:
+        images_padded = _column_to_image_indexed(cols, padded_shape, images_shape, filter_shape,
+                                                 (pad_h, pad_w), stride)
+
+    # Return image without padding
+    return images_padded[:, :, pad_h[0]:height+pad_h[0], pad_w[0]:width+pad_w[0]]
+
+
+def _column_to_image_windows(cols, padded_shape, filter_shape, stride):
+    batch_size, channels, height_padded, width_padded = padded_shape
+    filter_height, filter_width = filter_shape
+    out_height = (height_padded - filter_height) // stride + 1
+    out_width = (width_padded - filter_width) // stride + 1
+    cols = cols.reshape(channels, filter_height, filter_width, out_height, out_width, batch_size)
+    # Accumulate in the (channels, height, width, batch_size) order of the columns so that
+    # both sides of the additions are read row by row
+    accumulated = np.zeros((channels, height_padded, width_padded, batch_size), dtype=cols.dtype)
+    # Every filter position adds to a strided grid of the image, and the grids of one
+    # position never overlap, so a plain slice assignment accumulates correctly
+    for y in range(filter_height):
+        for x in range(filter_width):
+            accumulated[:, y:y + stride * out_height:stride, x:x + stride * out_width:stride] += cols[:, y, x]
+    return accumulated.transpose(3, 0, 1, 2)
+
+
+def _column_to_image_indexed(cols, padded_shape, images_shape, filter_shape, padding, stride):
+    batch_size, channels, height, width = images_shape
+    images_padded = np.zeros(padded_shape, dtype=cols.dtype)
 
     # Calculate the indices where the dot products are applied between weights
     # and the image
-    k, i, j = get_im2col_indices(images_shape, filter_shape, (pad_h, pad_w), stride)
+    k, i, j = get_im2col_indices(images_shape, filter_shape, padding, stride)
 
     cols = cols.reshape(channels * np.prod(filter_shape), -1, batch_size)
     cols = cols.transpose(2, 0, 1)
     # Add column content to the images at the indices
     np.add.at(images_padded, (slice(None), k, i, j), cols)
-
-    # Return image without padding
-    return images_padded[:, :, pad_h[0]:height+pad_h[0], pad_w[0]:width+pad_w[0]]
+    return images_padded
@@ -38,4 +38,28 @@ class CrossEntropy(Loss):
         p = np.clip(p, 1e-15, 1 - 1e-15)
         return - (y / p) + (1 - y) / (1 - p)
 
+class SoftmaxCrossEntropy(Loss):
+    """ Cross entropy of a softmax over the logits. Takes logits instead of probabilities,
+    works in log space and has gradient p - y w.r.t. the logits, so neither the softmax
+    Jacobian nor any clipping is needed. """
+    def __init__(self): pass
+
+    def log_softmax(self, logits):
+        shifted = logits - np.max(logits, axis=-1, keepdims=True)
+        return shifted - np.log(np.sum(np.exp(shifted), axis=-1, keepdims=True))
+
+    def softmax(self, logits):
+        return np.exp(self.log_softmax(logits))
+
+    def loss(self, y, logits):
+        return - np.sum(y * self.log_softmax(logits), axis=-1)
+
+    def acc(self, y, logits):
+        return accuracy_score(np.argmax(y, axis=1), np.argmax(logits, axis=1))
+
+    def gradient(self, y, logits):
+        return self.softmax(logits) - y
 
+    def hess(self, y, logits):
+        p = self.softmax(logits)
+        return p * (1 - p)
@@ -6,65 +6,116 @@ from mlfromscratch.utils import Plot, accuracy_score
 
 class NaiveBayes():
     """The Gaussian Naive Bayes classifier. """
+    def __init__(self):
+        self.classes = np.array([])
+        self.class_count = np.zeros(0)
+        self.mean = None
+        self.var = None
+        self.log_prior = None
+
     def fit(self, X, y):
-        self.X, self.y = X, y
-        self.classes = np.unique(y)
-        self.parameters = []
-        # Calculate the mean and variance of each feature for each class
+        """ Fit the model on X and y, discarding anything learned before """
+        self.__init__()
+        return self.partial_fit(X, y)
+
+    def fit_stream(self, chunks):
+        """ Fit the model on an iterable of (X_chunk, y_chunk) pairs, e.g. one per day of
+        data, without ever holding more than one chunk """
+        self.__init__()
+        for X_chunk, y_chunk in chunks:
+            self.partial_fit(X_chunk, y_chunk)
+        return self
+
+    def partial_fit(self, X, y):
+        """ Update the per class count, mean and variance of each feature with one chunk of
+        data. The statistics of the chunk are merged with the parallel Welford update, so
+        the result equals fitting on all chunks at once. The chunk is not kept. """
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y)
+        self._add_classes(np.unique(y), np.shape(X)[1])
         for i, c in enumerate(self.classes):
             # Only select the rows where the label equals the given class
-            X_where_c = X[np.where(y == c)]
-            self.parameters.append([])
-            # Add the mean and variance for each feature (column)
-            for col in X_where_c.T:
-                parameters = {"mean": col.mean(), "var": col.var()}
-                self.parameters[i].append(parameters)
+            X_where_c = X[y == c]
+            n_chunk = len(X_where_c)
+            if n_chunk == 0:
+                continue
+            mean_chunk = X_where_c.mean(axis=0)
+            var_chunk = X_where_c.var(axis=0)
+            n_seen = self.class_count[i]
+            n_total = n_seen + n_chunk
+            delta = mean_chunk - self.mean[i]
+            # Sum of squared deviations from the mean of both parts and the shift between them
+            m2 = self.var[i] * n_seen + var_chunk * n_chunk + np.power(delta, 2) * n_seen * n_chunk / n_total
+            self.mean[i] += delta * n_chunk / n_total
+            self.var[i] = m2 / n_total
+            self.class_count[i] = n_total
+        self.log_prior = np.log(self.class_count / np.sum(self.class_count))
+        return self
 
-    def _calculate_likelihood(self, mean, var, x):
-        """ Gaussian likelihood of the data x given mean and var """
-        eps = 1e-4 # Added in denominator to prevent division by zero
-        coeff = 1.0 / math.sqrt(2.0 * math.pi * var + eps)
-        exponent = math.exp(-(math.pow(x - mean, 2) / (2 * var + eps)))
-        return coeff * exponent
+    def _add_classes(self, classes, n_features):
+        """ Make room in the statistics for classes that have not been seen before """
+        if self.mean is None:
+            self.mean = np.zeros((0, n_features))
+            self.var = np.zeros((0, n_features))
+        all_classes = np.union1d(self.classes, classes) if len(self.classes) else classes
+        if len(all_classes) == len(self.classes):
+            return
+        # Rows of the already seen classes in the new (sorted) class order
+        rows = np.searchsorted(all_classes, self.classes)
+        mean = np.zeros((len(all_classes), n_features))
+        var = np.zeros((len(all_classes), n_features))
+        class_count = np.zeros(len(all_classes))
+        mean[rows], var[rows], class_count[rows] = self.mean, self.var, self.class_count
+        self.classes, self.mean, self.var, self.class_count = all_classes, mean, var, class_count
 
-    def _calculate_prior(self, c):
-        """ Calculate the prior of class c
-        (samples where class == c / total number of samples)"""
-        frequency = np.mean(self.y == c)
-        return frequency
+    def _calculate_log_likelihood(self, X):
+        """ Gaussian log likelihood of every sample in X given the mean and var of every
+        class, summed over the features. The square (x - mean)^2 is expanded into
+        x^2 - 2 * x * mean + mean^2, so the sums over the features are matrix products and
+        only (n_samples, n_classes) arrays are allocated. X and the means are first centered
+        on the mean of the class means, since the expansion cancels catastrophically when
+        a feature's offset is large compared with its spread. Returns (n_samples, n_classes). """
+        eps = 1e-4 # Added in denominator to prevent division by zero
+        center = np.mean(self.mean, axis=0)
+        X = np.asarray(X, dtype=float) - center
+        mean = self.mean - center
+        inv_denominator = 1 / (2 * self.var + eps)
+        log_likelihood = np.square(X).dot(inv_denominator.T)
+        log_likelihood -= 2 * X.dot((mean * inv_denominator).T)
+        log_likelihood += np.sum(np.square(mean) * inv_denominator, axis=1)
+        np.negative(log_likelihood, out=log_likelihood)
+        log_likelihood -= 0.5 * np.sum(np.log(2.0 * math.pi * self.var + eps), axis=1)
+        return log_likelihood
 
-    def _classify(self, sample):
+    def _joint_log_likelihood(self, X):
         """ Classification using Bayes Rule P(Y|X) = P(X|Y)*P(Y)/P(X),
             or Posterior = Likelihood * Prior / Scaling Factor
 
         P(Y|X) - The posterior is the probability that sample x is of class y given the
                  feature values of x being distributed according to distribution of y and the prior.
         P(X|Y) - Likelihood of data X given class distribution Y.
-                 Gaussian distribution (given by _calculate_likelihood)
-        P(Y)   - Prior (given by _calculate_prior)
+                 Gaussian distribution (given by _calculate_log_likelihood)
+        P(Y)   - Prior, the fraction of the samples of class Y (log_prior)
         P(X)   - Scales the posterior to make it a proper probability distribution.
-                 This term is ignored in this implementation since it doesn't affect
-                 which class distribution the sample is most likely to belong to.
+                 This term is ignored here since it doesn't affect which class
+                 distribution the sample is most likely to belong to.
 
-        Classifies the sample as the class that results in the largest P(Y|X) (posterior)
+        Works in log space for the whole batch: the naive assumption (independence)
+        P(x1,x2,x3|Y) = P(x1|Y)*P(x2|Y)*P(x3|Y) becomes a sum of log likelihoods, which does
+        not underflow the way a product of many small likelihoods does.
+        Returns log(P(X|Y)*P(Y)) as (n_samples, n_classes).
         """
-        posteriors = []
-        # Go through list of classes
-        for i, c in enumerate(self.classes):
-            # Initialize posterior as prior
-            posterior = self._calculate_prior(c)
-            # Naive assumption (independence):
-            # P(x1,x2,x3|Y) = P(x1|Y)*P(x2|Y)*P(x3|Y)
-            # Posterior is product of prior and likelihoods (ignoring scaling factor)
-            for feature_value, params in zip(sample, self.parameters[i]):
-                # Likelihood of feature value given distribution of feature values given y
-                likelihood = self._calculate_likelihood(params["mean"], params["var"], feature_value)
-                posterior *= likelihood
-            posteriors.append(posterior)
-        # Return the class with the largest posterior probability
-        return self.classes[np.argmax(posteriors)]
+        return self.log_prior + self._calculate_log_likelihood(X)
+
+    def predict_log_proba(self, X):
+        """ Log of the posterior P(Y|X) of every class for the samples in X """
+        joint = self._joint_log_likelihood(X)
+        # Normalize by P(X) with the log-sum-exp trick
+        max_joint = np.max(joint, axis=1, keepdims=True)
+        log_evidence = max_joint + np.log(np.sum(np.exp(joint - max_joint), axis=1, keepdims=True))
+        return joint - log_evidence
 
     def predict(self, X):
-        """ Predict the class labels of the samples in X """
-        y_pred = [self._classify(sample) for sample in X]
-        return y_pred
+        """ Predict the class labels of the samples in X as the class with the largest
+        posterior probability """
+        return self.classes[np.argmax(self._joint_log_likelihood(X), axis=1)]
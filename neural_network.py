@@ -1,9 +1,15 @@
 from __future__ import print_function, division
 from terminaltables import AsciiTable
+import copy
+import contextlib
 import numpy as np
 import progressbar
-from mlfromscratch.utils import batch_iterator
 from mlfromscratch.utils.misc import bar_widgets
+from mlfromscratch.deep_learning.loss_functions import CrossEntropy, SoftmaxCrossEntropy
+from mlfromscratch.deep_learning.layers import Activation, im2col_cache_info
+from mlfromscratch.deep_learning.activation_functions import Softmax
+from mlfromscratch.deep_learning.data_loader import DataLoader, in_memory
+from mlfromscratch.deep_learning.inference import InferenceModel, compile_layers
 
 
 class NeuralNetwork():
@@ -16,14 +22,43 @@ class NeuralNetwork():
         the loss.
     loss: class
         Loss function used to measure the model's performance. SquareLoss or CrossEntropy.
+        If the last layer is Activation('softmax') and the loss is CrossEntropy, training
+        and evaluation skip that layer and use SoftmaxCrossEntropy on the logits instead,
+        whose gradient is p - y. predict still returns the softmax probabilities.
     validation: tuple
         A tuple containing validation data and labels (X, y)
+    dtype: numpy dtype
+        The dtype of the weights, of the inputs and of the values passed between the
+        layers. np.float32 halves the memory traffic of the matrix products.
+    optimizer_dtype: numpy dtype
+        The dtype of the optimizer state (momentum, moment estimates). Defaults to dtype.
+        Use np.float64 to accumulate the state of float32 weights in double precision.
+    fused_optimizer: boolean
+        If True the parameters of all trainable layers are packed into one flat buffer and
+        the optimizer updates them in place with one step per batch, instead of one update
+        per parameter. The optimizer state is reset when the layers or their trainability
+        change. NesterovAcceleratedGradient is not supported.
     """
-    def __init__(self, optimizer, loss, validation_data=None):
+    def __init__(self, optimizer, loss, validation_data=None, dtype=np.float64,
+                 optimizer_dtype=None, fused_optimizer=False):
         self.optimizer = optimizer
+        self.fused_optimizer = fused_optimizer
+        if fused_optimizer and not hasattr(optimizer, "step"):
+            raise ValueError("%s has no in place step for the fused optimizer" % type(optimizer).__name__)
+        self.flat_parameters = None
+        # True inside inference(), where the layers keep nothing for backprop
+        self.inference_mode = False
+        # Learning rate set by a scheduler, None while the optimizer's own rate is used
+        self.learning_rate = None
+        self.dtype = np.dtype(dtype)
+        if optimizer_dtype is not None:
+            self.optimizer.state_dtype = optimizer_dtype
         self.layers = []
         self.errors = {"training": [], "validation": []}
+        # Counters of the im2col index cache of every epoch (see layers.im2col_cache_info)
+        self.im2col_cache_stats = []
         self.loss_function = loss()
+        self.softmax_cross_entropy = SoftmaxCrossEntropy()
         self.progressbar = progressbar.ProgressBar(widgets=bar_widgets)
 
         self.val_set = None
@@ -35,6 +70,7 @@ class NeuralNetwork():
         """ Method which enables freezing of the weights of the network's layers. """
         for layer in self.layers:
             layer.trainable = trainable
+        self.flat_parameters = None
 
     def add(self, layer):
         """ Method which adds a layer to the neural network """
@@ -43,61 +79,169 @@ class NeuralNetwork():
         if self.layers:
             layer.set_input_shape(shape=self.layers[-1].output_shape())
 
+        layer.dtype = self.dtype
+
         # If the layer has weights that needs to be initialized 
         if hasattr(layer, 'initialize'):
             layer.initialize(optimizer=self.optimizer)
 
         # Add layer to the network
         self.layers.append(layer)
+        self.flat_parameters = None
 
-    def test_on_batch(self, X, y):
-        """ Evaluates the model over a single batch of samples """
-        y_pred = self._forward_pass(X, training=False)
-        loss = np.mean(self.loss_function.loss(y, y_pred))
-        acc = self.loss_function.acc(y, y_pred)
+    def test_on_batch(self, X, y, batch_size=None):
+        """ Evaluates the model over a single batch of samples. With batch_size the samples
+        are evaluated batch by batch, which bounds the memory. X and y may also be
+        memory-mapped arrays, paths of .npy files or a ChunkedSource (with y None), which are
+        always evaluated in batches (default 256) read from disk. """
+        layers, loss_function = self._training_layers()
+        if in_memory(X) and batch_size is None:
+            y_pred = self._forward_pass(X, training=False, layers=layers)
+            loss = np.mean(loss_function.loss(y, y_pred))
+            acc = loss_function.acc(y, y_pred)
+            return loss, acc
 
-        return loss, acc
+        # Means over the batches, weighted by the batch sizes
+        total_loss, total_acc, n_samples = 0, 0, 0
+        for X_batch, y_batch in self._inference_batches(X, y, batch_size or 256):
+            y_pred = self._forward_pass(X_batch, training=False, layers=layers)
+            total_loss += np.mean(loss_function.loss(y_batch, y_pred)) * len(X_batch)
+            total_acc += loss_function.acc(y_batch, y_pred) * len(X_batch)
+            n_samples += len(X_batch)
+
+        return total_loss / n_samples, total_acc / n_samples
 
     def train_on_batch(self, X, y):
         """ Single gradient update over one batch of samples """
-        y_pred = self._forward_pass(X)
-        loss = np.mean(self.loss_function.loss(y, y_pred))
-        acc = self.loss_function.acc(y, y_pred)
+        if self.inference_mode:
+            raise RuntimeError("The model can not be trained in inference mode")
+        layers, loss_function = self._training_layers()
+        y_pred = self._forward_pass(X, layers=layers)
+        loss = np.mean(loss_function.loss(y, y_pred))
+        acc = loss_function.acc(y, y_pred)
         # Calculate the gradient of the loss function wrt y_pred
-        loss_grad = self.loss_function.gradient(y, y_pred)
+        loss_grad = loss_function.gradient(y, y_pred).astype(self.dtype, copy=False)
+        if self.fused_optimizer and self.flat_parameters is None:
+            self._pack_parameters()
         # Backpropagate. Update weights
-        self._backward_pass(loss_grad=loss_grad)
+        self._backward_pass(loss_grad=loss_grad, layers=layers)
+        if self.fused_optimizer:
+            self.flat_optimizer.step(self.flat_parameters, self.flat_gradients)
 
         return loss, acc
 
-    def fit(self, X, y, n_epochs, batch_size):
-        """ Trains the model for a fixed number of epochs """
-        for _ in self.progressbar(range(n_epochs)):
-            
+    def _training_layers(self):
+        """ The layers and loss that training and evaluation use. A final softmax activation
+        followed by cross entropy is fused into SoftmaxCrossEntropy on the logits. """
+        if (isinstance(self.loss_function, CrossEntropy) and self.layers
+                and isinstance(self.layers[-1], Activation)
+                and isinstance(self.layers[-1].activation_func, Softmax)):
+            return self.layers[:-1], self.softmax_cross_entropy
+        return self.layers, self.loss_function
+
+    def _pack_parameters(self):
+        """ Move the parameters of the trainable layers into one flat buffer. The layers
+        keep views into it, and get views into a flat gradient buffer of the same layout
+        that their backward pass writes to. """
+        slots = [(layer, name) for layer in self.layers if layer.trainable
+                 for name in layer.parameter_names]
+        size = sum(np.size(getattr(layer, name)) for layer, name in slots)
+        self.flat_parameters = np.empty(size, dtype=self.dtype)
+        self.flat_gradients = np.zeros(size, dtype=self.dtype)
+        self.flat_optimizer = copy.copy(self.optimizer)
+        if self.learning_rate is not None:
+            self.flat_optimizer.learning_rate = self.learning_rate
+        for layer in self.layers:
+            layer.flat_gradients = {} if layer.trainable else None
+        offset = 0
+        for layer, name in slots:
+            parameter = getattr(layer, name)
+            view = slice(offset, offset + parameter.size)
+            self.flat_parameters[view] = parameter.ravel()
+            setattr(layer, name, self.flat_parameters[view].reshape(parameter.shape))
+            layer.flat_gradients[name] = self.flat_gradients[view].reshape(parameter.shape)
+            offset += parameter.size
+
+    def fit(self, X, y, n_epochs, batch_size, scheduler=None, shuffle=False, seed=None,
+            block_size=None):
+        """ Trains the model for a fixed number of epochs. A scheduler from optimizers.py
+        (e.g. CosineAnnealing or ReduceOnPlateau) sets the learning rate before every epoch.
+        Batches are prepared by a background thread (see DataLoader), in a new random
+        order every epoch if shuffle is True. X and y may be memory-mapped arrays or paths of
+        .npy files, and X may be a ChunkedSource of (X_chunk, y_chunk) pairs (with y None).
+        Only the batches in flight are held in memory. block_size shuffles in blocks of
+        consecutive samples, which keeps the reads from disk local. """
+        batches = DataLoader(X, y, batch_size=batch_size, shuffle=shuffle, seed=seed, dtype=self.dtype,
+                             block_size=block_size)
+        loss = None
+        im2col_cache_info(reset=True)
+        for epoch in self.progressbar(range(n_epochs)):
+            if scheduler is not None:
+                self._set_learning_rate(scheduler(epoch, self.optimizer.learning_rate, loss))
+
             batch_error = []
-            for X_batch, y_batch in batch_iterator(X, y, batch_size=batch_size):
+            for X_batch, y_batch in batches:
                 loss, _ = self.train_on_batch(X_batch, y_batch)
                 batch_error.append(loss)
 
             self.errors["training"].append(np.mean(batch_error))
+            loss = self.errors["training"][-1]
 
             if self.val_set is not None:
-                val_loss, _ = self.test_on_batch(self.val_set["X"], self.val_set["y"])
+                val_loss, _ = self.test_on_batch(self.val_set["X"], self.val_set["y"], batch_size=batch_size)
                 self.errors["validation"].append(val_loss)
+                loss = val_loss
+
+            self.im2col_cache_stats.append(im2col_cache_info(reset=True))
 
         return self.errors["training"], self.errors["validation"]
 
-    def _forward_pass(self, X, training=True):
-        """ Calculate the output of the NN """
-        layer_output = X
+    def _set_learning_rate(self, learning_rate):
+        """ Set the learning rate of the optimizers of all parameters """
+        self.learning_rate = learning_rate
+        if self.fused_optimizer and self.flat_parameters is not None:
+            self.flat_optimizer.learning_rate = learning_rate
         for layer in self.layers:
+            for name in layer.parameter_names:
+                optimizer = getattr(layer, name + "_opt", None)
+                if optimizer is not None:
+                    optimizer.learning_rate = learning_rate
+
+    @contextlib.contextmanager
+    def inference(self):
+        """ Context in which the model is only used for predictions and evaluation. The
+        layers drop what they kept for backprop and keep nothing during the forward pass,
+        and BatchNormalization is folded into a scale and shift from its running
+        statistics. Training is not allowed inside the context.
+
+        with model.inference():
+            y_pred = model.predict(X)
+        """
+        if self.inference_mode:
+            yield self
+            return
+        self.inference_mode = True
+        for layer in self.layers:
+            layer.set_inference(True)
+        try:
+            yield self
+        finally:
+            self.inference_mode = False
+            for layer in self.layers:
+                layer.set_inference(False)
+
+    def _forward_pass(self, X, training=True, layers=None):
+        """ Calculate the output of the NN """
+        training = training and not self.inference_mode
+        layer_output = np.asarray(X, dtype=self.dtype)
+        for layer in (self.layers if layers is None else layers):
             layer_output = layer.forward_pass(layer_output, training)
 
         return layer_output
 
-    def _backward_pass(self, loss_grad):
+    def _backward_pass(self, loss_grad, layers=None):
         """ Propagate the gradient 'backwards' and update the weights in each layer """
-        for layer in reversed(self.layers):
+        for layer in reversed(self.layers if layers is None else layers):
             loss_grad = layer.backward_pass(loss_grad)
 
     def summary(self, name="Model Summary"):
@@ -118,6 +262,38 @@ class NeuralNetwork():
         print (AsciiTable(table_data).table)
         print ("Total Parameters: %d\n" % tot_params)
 
-    def predict(self, X):
-        """ Use the trained model to predict labels of X """
-        return self._forward_pass(X, training=False)
+    def predict(self, X, batch_size=None):
+        """ Use the trained model to predict labels of X. With batch_size X is predicted
+        batch by batch. Memory-mapped arrays, paths of .npy files and a ChunkedSource are
+        always predicted in batches (default 256) read from disk. """
+        if in_memory(X) and batch_size is None:
+            return self._forward_pass(X, training=False)
+        return np.concatenate(list(self.predict_iter(X, batch_size=batch_size or 256)))
+
+    def predict_iter(self, X, batch_size=256):
+        """ Generator of the predictions of X, one batch at a time """
+        for X_batch, _ in self._inference_batches(X, batch_size=batch_size):
+            y_pred = self._forward_pass(X_batch, training=False)
+            if not in_memory(X):
+                # The output may be a view of the batch buffer, which is reused
+                y_pred = np.array(y_pred)
+            yield y_pred
+
+    def compile_for_inference(self, max_batch_size=256):
+        """ A frozen, picklable copy of the trained model for predictions only, with batch
+        normalization folded into the weights, dropout removed, most activations fused into
+        the layer before them and buffers preallocated for max_batch_size samples. See
+        InferenceModel. Later training of this model does not change it. """
+        ops = compile_layers(self.layers, dtype=self.dtype)
+        return InferenceModel(ops, self.layers[0].input_shape, self.layers[-1].output_shape(),
+                              max_batch_size=max_batch_size, dtype=self.dtype)
+
+    def _inference_batches(self, X, y=None, batch_size=256):
+        """ Batches of X and y for evaluation: slices of arrays in memory, and batches read
+        by a DataLoader otherwise """
+        if not in_memory(X):
+            for batch in DataLoader(X, y, batch_size=batch_size, dtype=self.dtype):
+                yield batch
+            return
+        for start in range(0, len(X), batch_size):
+            yield X[start:start + batch_size], None if y is None else y[start:start + batch_size]
@@ -5,129 +5,271 @@ from mlfromscratch.utils import make_diagonal, normalize
 # weights that minimizes the loss.
 # A great resource for understanding these methods: 
 # http://sebastianruder.com/optimizing-gradient-descent/index.html
+#
+# The state of an optimizer (momentum, moment estimates) is kept in state_dtype, which
+# defaults to the dtype of the weights. The updated weights keep the dtype of the weights,
+# so float32 weights may be trained with float64 state.
 
-class StochasticGradientDescent():
+def _zeros_state(optimizer, w):
+    dtype = optimizer.state_dtype or np.result_type(np.asarray(w).dtype, np.float32)
+    return np.zeros(np.shape(w), dtype=dtype)
+
+def _cast_like(w, new_w):
+    """ The updated weights in the dtype of the weights """
+    dtype = getattr(w, "dtype", None)
+    if dtype is None or new_w.dtype == dtype:
+        return new_w
+    return new_w.astype(dtype)
+
+class Optimizer(object):
+    """ Base of the optimizers that update the weights in place. step(w, grad) moves w
+    against the gradient without allocating: the state and a scratch array of the shape
+    of w are allocated on the first step and reused. update(w, grad) returns the updated
+    weights as a new array and leaves w untouched. """
+    state_dtype = None
+
+    def update(self, w, grad_wrt_w):
+        w = np.array(w, dtype=np.result_type(np.asarray(w).dtype, np.float32))
+        self.step(w, grad_wrt_w)
+        return w
+
+    def step(self, w, grad_wrt_w):
+        raise NotImplementedError()
+
+    def _scratch(self, w):
+        scratch = getattr(self, "_scratch_buffer", None)
+        if scratch is None or scratch.shape != np.shape(w):
+            scratch = self._scratch_buffer = _zeros_state(self, w)
+        return scratch
+
+class StochasticGradientDescent(Optimizer):
     def __init__(self, learning_rate=0.01, momentum=0):
         self.learning_rate = learning_rate 
         self.momentum = momentum
         self.w_updt = None
+        self.state_dtype = None
 
-    def update(self, w, grad_wrt_w):
+    def step(self, w, grad_wrt_w):
         # If not initialized
         if self.w_updt is None:
-            self.w_updt = np.zeros(np.shape(w))
+            self.w_updt = _zeros_state(self, w)
+        scratch = self._scratch(w)
         # Use momentum if set
-        self.w_updt = self.momentum * self.w_updt + (1 - self.momentum) * grad_wrt_w
+        self.w_updt *= self.momentum
+        self.w_updt += np.multiply(grad_wrt_w, 1 - self.momentum, out=scratch)
         # Move against the gradient to minimize loss
-        return w - self.learning_rate * self.w_updt
+        w -= np.multiply(self.w_updt, self.learning_rate, out=scratch)
 
 class NesterovAcceleratedGradient():
+    # Needs the gradient function instead of the gradient, so it has no in place step
     def __init__(self, learning_rate=0.001, momentum=0.4):
         self.learning_rate = learning_rate 
         self.momentum = momentum
         self.w_updt = np.array([])
+        self.state_dtype = None
 
     def update(self, w, grad_func):
         # Calculate the gradient of the loss a bit further down the slope from w
         approx_future_grad = np.clip(grad_func(w - self.momentum * self.w_updt), -1, 1)
         # Initialize on first update
         if not self.w_updt.any():
-            self.w_updt = np.zeros(np.shape(w))
+            self.w_updt = _zeros_state(self, w)
 
         self.w_updt = self.momentum * self.w_updt + self.learning_rate * approx_future_grad
         # Move against the gradient to minimize loss
-        return w - self.w_updt
+        return _cast_like(w, w - self.w_updt)
 
-class Adagrad():
+class Adagrad(Optimizer):
     def __init__(self, learning_rate=0.01):
         self.learning_rate = learning_rate
         self.G = None # Sum of squares of the gradients
         self.eps = 1e-8
+        self.state_dtype = None
 
-    def update(self, w, grad_wrt_w):
+    def step(self, w, grad_wrt_w):
         # If not initialized
         if self.G is None:
-            self.G = np.zeros(np.shape(w))
+            self.G = _zeros_state(self, w)
+        scratch = self._scratch(w)
         # Add the square of the gradient of the loss function at w
-        self.G += np.power(grad_wrt_w, 2)
+        self.G += np.square(grad_wrt_w, out=scratch)
         # Adaptive gradient with higher learning rate for sparse data
-        return w - self.learning_rate * grad_wrt_w / np.sqrt(self.G + self.eps)
+        np.add(self.G, self.eps, out=scratch)
+        np.sqrt(scratch, out=scratch)
+        np.divide(grad_wrt_w, scratch, out=scratch)
+        scratch *= self.learning_rate
+        w -= scratch
 
-class Adadelta():
-    def __init__(self, rho=0.95, eps=1e-6):
+class Adadelta(Optimizer):
+    # learning_rate only scales the step, so that a scheduler can adjust it
+    def __init__(self, learning_rate=1.0, rho=0.95, eps=1e-6):
+        self.learning_rate = learning_rate
         self.E_w_updt = None # Running average of squared parameter updates
         self.E_grad = None   # Running average of the squared gradient of w
         self.w_updt = None   # Parameter update
         self.eps = eps
         self.rho = rho
+        self.state_dtype = None
 
-    def update(self, w, grad_wrt_w):
+    def step(self, w, grad_wrt_w):
         # If not initialized
         if self.w_updt is None:
-            self.w_updt = np.zeros(np.shape(w))
-            self.E_w_updt = np.zeros(np.shape(w))
-            self.E_grad = np.zeros(np.shape(grad_wrt_w))
+            self.w_updt = _zeros_state(self, w)
+            self.E_w_updt = _zeros_state(self, w)
+            self.E_grad = _zeros_state(self, grad_wrt_w)
+        scratch = self._scratch(w)
 
         # Update average of gradients at w
-        self.E_grad = self.rho * self.E_grad + (1 - self.rho) * np.power(grad_wrt_w, 2)
-        
-        RMS_delta_w = np.sqrt(self.E_w_updt + self.eps)
-        RMS_grad = np.sqrt(self.E_grad + self.eps)
+        self.E_grad *= self.rho
+        np.square(grad_wrt_w, out=scratch)
+        scratch *= 1 - self.rho
+        self.E_grad += scratch
 
-        # Adaptive learning rate
-        adaptive_lr = RMS_delta_w / RMS_grad
+        # Adaptive learning rate: RMS of the updates over RMS of the gradients
+        np.add(self.E_w_updt, self.eps, out=self.w_updt)
+        np.sqrt(self.w_updt, out=self.w_updt)
+        np.add(self.E_grad, self.eps, out=scratch)
+        np.sqrt(scratch, out=scratch)
+        self.w_updt /= scratch
 
         # Calculate the update
-        self.w_updt = adaptive_lr * grad_wrt_w
+        self.w_updt *= grad_wrt_w
 
         # Update the running average of w updates
-        self.E_w_updt = self.rho * self.E_w_updt + (1 - self.rho) * np.power(self.w_updt, 2)
+        self.E_w_updt *= self.rho
+        np.square(self.w_updt, out=scratch)
+        scratch *= 1 - self.rho
+        self.E_w_updt += scratch
 
-        return w - self.w_updt
+        w -= np.multiply(self.w_updt, self.learning_rate, out=scratch)
 
-class RMSprop():
+class RMSprop(Optimizer):
     def __init__(self, learning_rate=0.01, rho=0.9):
         self.learning_rate = learning_rate
         self.Eg = None # Running average of the square gradients at w
         self.eps = 1e-8
         self.rho = rho
+        self.state_dtype = None
 
-    def update(self, w, grad_wrt_w):
+    def step(self, w, grad_wrt_w):
         # If not initialized
         if self.Eg is None:
-            self.Eg = np.zeros(np.shape(grad_wrt_w))
+            self.Eg = _zeros_state(self, grad_wrt_w)
+        scratch = self._scratch(w)
 
-        self.Eg = self.rho * self.Eg + (1 - self.rho) * np.power(grad_wrt_w, 2)
+        self.Eg *= self.rho
+        np.square(grad_wrt_w, out=scratch)
+        scratch *= 1 - self.rho
+        self.Eg += scratch
 
         # Divide the learning rate for a weight by a running average of the magnitudes of recent
         # gradients for that weight
-        return w - self.learning_rate *  grad_wrt_w / np.sqrt(self.Eg + self.eps)
+        np.add(self.Eg, self.eps, out=scratch)
+        np.sqrt(scratch, out=scratch)
+        np.divide(grad_wrt_w, scratch, out=scratch)
+        scratch *= self.learning_rate
+        w -= scratch
 
-class Adam():
+class Adam(Optimizer):
     def __init__(self, learning_rate=0.001, b1=0.9, b2=0.999):
         self.learning_rate = learning_rate
         self.eps = 1e-8
         self.m = None
         self.v = None
+        self.w_updt = None
         # Decay rates
         self.b1 = b1
         self.b2 = b2
+        self.t = 0 # Number of steps taken, for the bias correction of m and v
+        self.state_dtype = None
 
-    def update(self, w, grad_wrt_w):
+    def step(self, w, grad_wrt_w):
         # If not initialized
         if self.m is None:
-            self.m = np.zeros(np.shape(grad_wrt_w))
-            self.v = np.zeros(np.shape(grad_wrt_w))
-        
-        self.m = self.b1 * self.m + (1 - self.b1) * grad_wrt_w
-        self.v = self.b2 * self.v + (1 - self.b2) * np.power(grad_wrt_w, 2)
+            self.m = _zeros_state(self, grad_wrt_w)
+            self.v = _zeros_state(self, grad_wrt_w)
+            self.w_updt = _zeros_state(self, w)
+        self.t += 1
+
+        self.m *= self.b1
+        self.m += np.multiply(grad_wrt_w, 1 - self.b1, out=self.w_updt)
+        self.v *= self.b2
+        np.square(grad_wrt_w, out=self.w_updt)
+        self.w_updt *= 1 - self.b2
+        self.v += self.w_updt
+
+        # learning_rate * m_hat / (sqrt(v_hat) + eps), where the bias corrected estimates
+        # are m_hat = m / (1 - b1^t) and v_hat = v / (1 - b2^t)
+        np.divide(self.v, 1 - self.b2 ** self.t, out=self.w_updt)
+        np.sqrt(self.w_updt, out=self.w_updt)
+        self.w_updt += self.eps
+        np.divide(self.m, self.w_updt, out=self.w_updt)
+        self.w_updt *= self.learning_rate / (1 - self.b1 ** self.t)
+
+        w -= self.w_updt
+
+
+# Learning rate schedules. NeuralNetwork.fit calls the schedule before every epoch with
+# the index of the epoch, the learning rate the optimizer was created with and the loss
+# of the previous epoch (validation loss if there is validation data, None before the
+# first epoch), and sets the returned learning rate on the optimizer of every parameter.
+
+class StepDecay():
+    """ Multiplies the learning rate by gamma every step_size epochs """
+    def __init__(self, step_size=10, gamma=0.5):
+        self.step_size = step_size
+        self.gamma = gamma
+
+    def __call__(self, epoch, learning_rate, loss=None):
+        return learning_rate * self.gamma ** (epoch // self.step_size)
 
-        m_hat = self.m / (1 - self.b1)
-        v_hat = self.v / (1 - self.b2)
+class CosineAnnealing():
+    """ Anneals the learning rate from its initial value to min_learning_rate along half
+    a cosine over n_epochs epochs """
+    def __init__(self, n_epochs, min_learning_rate=0):
+        self.n_epochs = n_epochs
+        self.min_learning_rate = min_learning_rate
 
-        self.w_updt = self.learning_rate * m_hat / (np.sqrt(v_hat) + self.eps)
+    def __call__(self, epoch, learning_rate, loss=None):
+        progress = min(epoch, self.n_epochs) / self.n_epochs
+        return self.min_learning_rate + 0.5 * (learning_rate - self.min_learning_rate) * (
+            1 + np.cos(np.pi * progress))
 
-        return w - self.w_updt
+class Warmup():
+    """ Increases the learning rate linearly over warmup_epochs epochs, after which the
+    schedule 'then' (counted from the end of the warmup) or a constant rate is used """
+    def __init__(self, warmup_epochs=5, then=None):
+        self.warmup_epochs = warmup_epochs
+        self.then = then
 
+    def __call__(self, epoch, learning_rate, loss=None):
+        if epoch < self.warmup_epochs:
+            return learning_rate * (epoch + 1) / self.warmup_epochs
+        if self.then is None:
+            return learning_rate
+        return self.then(epoch - self.warmup_epochs, learning_rate, loss)
 
+class ReduceOnPlateau():
+    """ Multiplies the learning rate by factor when the loss has not improved by more than
+    min_delta for patience epochs """
+    def __init__(self, factor=0.5, patience=5, min_delta=1e-4, min_learning_rate=0):
+        self.factor = factor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.min_learning_rate = min_learning_rate
+        self.scale = 1.0
+        self.best_loss = np.inf
+        self.wait = 0
 
+    def __call__(self, epoch, learning_rate, loss=None):
+        if epoch == 0:
+            self.scale, self.best_loss, self.wait = 1.0, np.inf, 0
+        if loss is not None:
+            if loss < self.best_loss - self.min_delta:
+                self.best_loss, self.wait = loss, 0
+            else:
+                self.wait += 1
+                if self.wait >= self.patience:
+                    self.scale *= self.factor
+                    self.wait = 0
+        return max(learning_rate * self.scale, self.min_learning_rate)
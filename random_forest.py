@@ -1,10 +1,181 @@
 from __future__ import division, print_function
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from sklearn import datasets
+import progressbar
 from mlfromscratch.utils import train_test_split, accuracy_score, Plot
-from mlfromscratch.supervised_learning import RandomForest
+from mlfromscratch.utils.misc import bar_widgets
+from mlfromscratch.supervised_learning.decision_tree import ClassificationTree, bin_features
+
+
+class RandomForest():
+    """Random Forest classifier. Uses a collection of classification trees that
+    trains on random subsets of the data using a random subsets of the features.
+
+    Parameters:
+    -----------
+    n_estimators: int
+        The number of classification trees that are used.
+    max_features: int
+        The maximum number of features that the classification trees are allowed to
+        use.
+    min_samples_split: int
+        The minimum number of samples needed to make a split when building a tree.
+    min_gain: float
+        The minimum impurity required to split the tree further.
+    max_depth: int
+        The maximum depth of a tree.
+    n_jobs: int
+        The number of processes that fit and predict with the trees. -1 uses every core.
+        The training data is handed to the workers as memory-mapped files instead of
+        being pickled to each of them.
+    seed: int
+        Seed of the random streams of the trees. Every tree gets its own stream, so the
+        fitted forest does not depend on n_jobs.
+    splitter: string
+        Split search of the trees. Either 'best' or 'hist'. With 'hist' X is binned once
+        for all trees.
+    """
+    def __init__(self, n_estimators=100, max_features=None, min_samples_split=2,
+                 min_gain=0, max_depth=float("inf"), n_jobs=1, seed=None, splitter="best"):
+        self.n_estimators = n_estimators    # Number of trees
+        self.max_features = max_features    # Maxmimum number of features per tree
+        self.min_samples_split = min_samples_split
+        self.min_gain = min_gain            # Minimum information gain req. to continue
+        self.max_depth = max_depth          # Maximum depth for tree
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else max(1, n_jobs)
+        self.seed = seed
+        self.splitter = splitter
+
+        # Initialize decision trees
+        self.trees = []
+        for _ in range(n_estimators):
+            self.trees.append(
+                ClassificationTree(
+                    min_samples_split=self.min_samples_split,
+                    min_impurity=min_gain,
+                    max_depth=self.max_depth,
+                    splitter=splitter))
+
+    def fit(self, X, y):
+        n_samples, n_features = np.shape(X)
+        # If max_features have not been defined => select it as
+        # sqrt(n_features)
+        if not self.max_features:
+            self.max_features = int(math.sqrt(n_features))
+
+        seeds = np.random.SeedSequence(self.seed).spawn(self.n_estimators)
+        tasks = [(tree, tree_seed, self.max_features) for tree, tree_seed in zip(self.trees, seeds)]
+        arrays = {"X": X, "y": y}
+        if self.splitter == "hist":
+            codes, bin_edges = bin_features(X, self.trees[0].max_bins)
+            arrays.update(bin_codes=codes, bin_edges=_pad_edges(bin_edges))
+        if self.n_jobs == 1:
+            _worker_data.update(arrays)
+            try:
+                # A new bar per fit, since a bar can only be iterated once
+                bar = progressbar.ProgressBar(widgets=bar_widgets)
+                self.trees = [_fit_tree(task) for task in bar(tasks)]
+            finally:
+                _worker_data.clear()
+        else:
+            with _SharedArrays(**arrays) as shared:
+                with shared.pool(self.n_jobs) as pool:
+                    self.trees = list(pool.map(_fit_tree, tasks))
+
+    def predict(self, X):
+        X = np.asarray(X)
+        if self.n_jobs == 1:
+            y_preds = np.stack([tree.predict(X) for tree in self.trees], axis=1)
+        else:
+            chunks = np.array_split(np.arange(len(self.trees)), self.n_jobs)
+            with _SharedArrays(X=X) as shared:
+                with shared.pool(self.n_jobs) as pool:
+                    y_preds = np.concatenate(list(pool.map(
+                        _predict_trees, [[self.trees[i] for i in chunk] for chunk in chunks])), axis=1)
+
+        # Select the most common class prediction for each sample
+        labels, label_i = np.unique(y_preds, return_inverse=True)
+        label_i = label_i.reshape(y_preds.shape)
+        votes = np.stack([np.sum(label_i == i, axis=1) for i in range(len(labels))], axis=1)
+        return labels[np.argmax(votes, axis=1)]
+
+
+# Arrays the current process fits or predicts on (read-only)
+_worker_data = {}
+
+
+def _fit_tree(task):
+    """ Fit one tree on a bootstrap sample of the rows and a random subset of the features """
+    tree, tree_seed, max_features = task
+    X, y = _worker_data["X"], _worker_data["y"]
+    n_samples, n_features = np.shape(X)
+    rng = np.random.default_rng(tree_seed)
+    # Reuse the partition buffer of the previous tree fitted by this process
+    sample_index = _worker_data.get("sample_index")
+    if sample_index is None or len(sample_index) != n_samples:
+        sample_index = _worker_data["sample_index"] = np.empty(n_samples, dtype=np.intp)
+    sample_index[:] = rng.integers(0, n_samples, size=n_samples)
+    feature_index = np.sort(rng.choice(n_features, size=min(max_features, n_features), replace=False))
+    tree.fit(X, y, sample_index=sample_index, feature_index=feature_index, binned=_binned())
+    return tree
+
+
+def _pad_edges(bin_edges):
+    """ The bin edges of every feature as the rows of one array, padded with nan """
+    padded = np.full((len(bin_edges), max(len(edges) for edges in bin_edges)), np.nan)
+    for feature_i, edges in enumerate(bin_edges):
+        padded[feature_i, :len(edges)] = edges
+    return padded
+
+
+def _binned():
+    """ The codes and bin edges of X binned by RandomForest.fit, None without them """
+    if "bin_codes" not in _worker_data:
+        return None
+    if "binned" not in _worker_data:
+        bin_edges = [edges[~np.isnan(edges)] for edges in _worker_data["bin_edges"]]
+        _worker_data["binned"] = (_worker_data["bin_codes"], bin_edges)
+    return _worker_data["binned"]
+
+
+def _predict_trees(trees):
+    X = _worker_data["X"]
+    return np.stack([tree.predict(X) for tree in trees], axis=1)
+
+
+def _attach_arrays(paths):
+    for name, path in paths.items():
+        _worker_data[name] = np.load(path, mmap_mode="r")
+
+
+class _SharedArrays():
+    """ Writes arrays to memory-mapped .npy files that worker processes open read-only """
+    def __init__(self, **arrays):
+        self.arrays = arrays
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix="random_forest_")
+        self.paths = {}
+        for name, array in self.arrays.items():
+            self.paths[name] = os.path.join(self.directory, name + ".npy")
+            np.save(self.paths[name], np.asarray(array))
+        return self
+
+    def pool(self, n_jobs):
+        return ProcessPoolExecutor(max_workers=n_jobs, initializer=_attach_arrays,
+                                   initargs=(self.paths,))
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
 
 def main():
+    from sklearn import datasets
+
     data = datasets.load_digits()
     X = data.data
     y = data.target
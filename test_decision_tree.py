@@ -0,0 +1,56 @@
+from __future__ import division, print_function
+import numpy as np
+
+from mlfromscratch.supervised_learning.decision_tree import RegressionTree, ClassificationTree
+from mlfromscratch.supervised_learning.gradient_boosting import GradientBoostingRegressor
+
+
+def test_hist_splitter_constant_features_is_leaf():
+    X = np.ones((20, 3))
+    y = np.arange(20, dtype=float)
+    tree = RegressionTree(splitter="hist")
+    tree.fit(X, y)
+    assert np.allclose(tree.predict(X), np.mean(y))
+
+    tree = ClassificationTree(splitter="hist")
+    tree.fit(X, (y > 9).astype(int))
+    assert len(np.unique(tree.predict(X))) == 1
+
+
+def test_hist_splitter_skips_constant_features():
+    rng = np.random.RandomState(0)
+    X = np.column_stack((np.ones(50), rng.randn(50), np.zeros(50)))
+    y = (X[:, 1] > 0).astype(float)
+    tree = RegressionTree(splitter="hist")
+    tree.fit(X, y)
+    assert np.allclose(tree.predict(X), y)
+
+
+def test_hist_boosting_with_constant_sampled_columns():
+    rng = np.random.RandomState(0)
+    X = np.column_stack([np.ones(40)] * 9 + [rng.randn(40)])
+    y = X[:, -1]
+    model = GradientBoostingRegressor(n_estimators=10, splitter="hist", colsample=0.2, seed=0)
+    model.fit(X, y)
+    assert model.predict(X).shape == (40,)
+
+
+def test_presort_matches_best_on_integer_features():
+    rng = np.random.RandomState(0)
+    X = rng.randint(0, 5, (300, 4))
+    y = X[:, 0] * 2 + X[:, 1] + rng.randint(0, 2, 300)
+    for Tree, target in ((ClassificationTree, y % 3), (RegressionTree, y.astype(float))):
+        predictions = []
+        for splitter in ("best", "presort"):
+            tree = Tree(max_depth=4, splitter=splitter)
+            tree.fit(X, target)
+            predictions.append(tree.predict(X))
+        assert np.array_equal(predictions[0], predictions[1])
+
+
+def test_presort_string_features():
+    X = np.array([["a", "x"], ["b", "y"], ["a", "y"], ["c", "x"]] * 5, dtype=object)
+    y = (X[:, 0] == "a").astype(int)
+    tree = ClassificationTree(splitter="presort")
+    tree.fit(X, y)
+    assert np.array_equal(tree.predict(X), y)
@@ -0,0 +1,24 @@
+from __future__ import division, print_function
+import numpy as np
+import pytest
+
+from mlfromscratch.supervised_learning.gradient_boosting import GradientBoostingRegressor
+
+
+def test_fit_twice_with_early_stopping():
+    rng = np.random.RandomState(0)
+    X = rng.randn(200, 4)
+    y = X[:, 0] + 0.1 * rng.randn(200)
+    model = GradientBoostingRegressor(n_estimators=50, subsample=0.7, early_stopping_rounds=3, seed=0)
+    model.fit(X, y)
+    model.fit(X, y)
+    assert len(model.trees) == 50
+    assert model.n_trees <= 50
+    assert model.predict(X).shape == (200,)
+
+
+def test_early_stopping_without_out_of_bag_samples():
+    X = np.random.RandomState(0).randn(10, 2)
+    model = GradientBoostingRegressor(n_estimators=5, subsample=0.96, early_stopping_rounds=2)
+    with pytest.raises(ValueError):
+        model.fit(X, X[:, 0])
@@ -0,0 +1,23 @@
+from __future__ import division, print_function
+import math
+import numpy as np
+
+from mlfromscratch.supervised_learning.naive_bayes import NaiveBayes
+
+
+def _direct_log_likelihood(model, X):
+    eps = 1e-4
+    X = np.expand_dims(X, axis=1)
+    return np.sum(-0.5 * np.log(2.0 * math.pi * model.var + eps)
+                  - np.power(X - model.mean, 2) / (2 * model.var + eps), axis=2)
+
+
+def test_log_likelihood_with_large_feature_offset():
+    rng = np.random.RandomState(0)
+    y = rng.randint(0, 2, 2000)
+    X = rng.randn(2000, 5) + 0.5 * y[:, np.newaxis] + 1e8
+    model = NaiveBayes()
+    model.fit(X, y)
+    direct = _direct_log_likelihood(model, X)
+    assert np.allclose(model._calculate_log_likelihood(X), direct, rtol=0, atol=1e-6)
+    assert np.array_equal(model.predict(X), model.classes[np.argmax(direct + model.log_prior, axis=1)])
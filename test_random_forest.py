@@ -0,0 +1,15 @@
+from __future__ import division, print_function
+import numpy as np
+
+from mlfromscratch.supervised_learning.random_forest import RandomForest
+
+
+def test_fit_twice():
+    rng = np.random.RandomState(0)
+    X = rng.randn(60, 4)
+    y = (X[:, 0] > 0).astype(int)
+    model = RandomForest(n_estimators=3, seed=0)
+    model.fit(X, y)
+    first = model.predict(X)
+    model.fit(X, y)
+    assert np.array_equal(model.predict(X), first)